@@ -2,4 +2,6 @@ import plac
 
 from .cmd import ASToolMainCommand
 
-plac.Interpreter.call(ASToolMainCommand)
+# Guarded so that multiprocessing's spawned workers can import this module.
+if __name__ == "__main__":
+    plac.Interpreter.call(ASToolMainCommand)
@@ -3,13 +3,13 @@ import os
 import sys
 import logging
 
-import zlib
 import hwdecrypt
 from . import iceapi
 from . import bootstrap_promote
 from . import pkg_cmd
 from . import ctx
 from . import masters
+from . import master_diff as mdiff
 from .sv_config import SERVER_CONFIG
 import json
 
@@ -26,9 +26,12 @@ class ASToolMainCommand(object):
         "invalidate",
         "pkg_sync",
         "pkg_gc",
+        "pkg_dedupe",
+        "pkg_promote",
         "dl_master",
         "current_master",
         "master_gc",
+        "master_diff",
         "decrypt_master",
     )
 
@@ -160,6 +163,7 @@ class ASToolMainCommand(object):
         self,
         master: ("Master version", "option", "m"), # type: ignore
         force: ("Always re-download files", "flag", "f"), # type: ignore
+        workers: ("Number of files to download at once (default: 4)", "option", "w", int), # type: ignore
     ):
         if not master:
             master = self.live_master_check()
@@ -174,20 +178,17 @@ class ASToolMainCommand(object):
 
         langs = [self.context.server_config.get("language", "ja")]
         langs.extend(self.context.server_config.get("additional_languages") or [])
-        have_files = set()
+        files = {}
 
         for lang_code in langs:
             manifest = masters.download_remote_manifest(self.context, master, lang_code=lang_code)
             for file in manifest.files:
-                if file.name in have_files:
-                    continue
-                if not masters.file_is_valid(self.context, file) or force:
-                    LOGGER.info("Retrieving and decrypting %s...", file.name)
-                    masters.download_one(self.context, file)
-                    have_files.add(file.name)
-                else:
-                    LOGGER.info("File %s is still valid!", file.name)
-        
+                files.setdefault(file.name, file)
+
+        masters.download_files(
+            self.context, master, files.values(), force=force, workers=workers or masters.DOWNLOAD_WORKERS
+        )
+
         try:
             masters.update_current_link(self.context, master)
         except OSError as e:
@@ -196,6 +197,36 @@ class ASToolMainCommand(object):
         with self.context.enter_memo() as memo:
             memo["latest_complete_master"] = master
 
+    def master_diff(
+        self,
+        old: "Old master version", # type: ignore
+        new: "New master version", # type: ignore
+        output: ("Write changes to this file instead of stdout. If it ends in .db, it's an SQLite database", "option", "o"), # type: ignore
+    ):
+        langs = [self.context.server_config.get("language", "ja")]
+        langs.extend(self.context.server_config.get("additional_languages") or [])
+
+        if output and output.endswith(".db"):
+            if os.path.exists(output):
+                os.unlink(output)
+            summary = mdiff.diff_versions(
+                self.context, old, new, langs, lambda db: mdiff.SQLiteWriter(db, output)
+            )
+        elif output:
+            with open(output, "w") as out:
+                summary = mdiff.diff_versions(
+                    self.context, old, new, langs, lambda db: mdiff.JSONLinesWriter(db, out)
+                )
+        else:
+            summary = mdiff.diff_versions(
+                self.context, old, new, langs, lambda db: mdiff.JSONLinesWriter(db, sys.stdout)
+            )
+
+        for db_name, tables in summary.items():
+            LOGGER.info("%s: %d tables changed", db_name, len(tables))
+            for table, counts in tables.items():
+                LOGGER.info("  %s: %s", table, ", ".join(f"{n} {op}" for op, n in counts.items() if n))
+
     def decrypt_master(self, filename):
         wd = os.path.dirname(filename)
         auxinfo = os.path.join(wd, "auxinfo_i")
@@ -215,8 +246,7 @@ class ASToolMainCommand(object):
             print("File not in manifest")
 
         ks = file.getkeys()
-        keys = hwdecrypt.Keyset(ks[0], ks[1], ks[2])
-        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        stream = hwdecrypt.MasterStream(hwdecrypt.Keyset(ks[0], ks[1], ks[2]))
 
         with open(filename, "rb") as ef, open(f"{file}.dec", "wb") as of:
             while True:
@@ -224,10 +254,8 @@ class ASToolMainCommand(object):
                 if not chunk:
                     break
 
-                copy = bytearray(chunk)
-                hwdecrypt.decrypt(keys, copy)
-                of.write(decompressor.decompress(copy))
-            of.write(decompressor.flush())
+                of.write(stream.decompress(chunk))
+            of.write(stream.flush())
 
     def pkg_sync(
         self,
@@ -235,10 +263,31 @@ class ASToolMainCommand(object):
         validate_only: ("Don't download anything, just validate.", "flag", "n"), # type: ignore
         signal_cts: ("Path to write 'ready' to when finished using SAPI.", "option", "sfd"), # type: ignore
         lang: ("Asset language (default: ja)", "option", "g"), # type: ignore
+        workers: ("Number of concurrent downloads (default: adapt to throughput)", "option", "w", int), # type: ignore
+        rate_limit: ("Download rate limit in bytes/s, K/M/G suffixes allowed", "option", "r", pkg_cmd.parse_byte_rate), # type: ignore
+        verify: ("Check the size of every package on disk first", "flag", "V"), # type: ignore
+        durability: ("How hard to make sure packages survive a crash (default: batch)", "option", "D", str, ("none", "batch", "file")), # type: ignore
+        processes: ("Split the download across this many processes (needs aiohttp)", "option", "P", int), # type: ignore
+        progress_json: ("Also write progress reports to this file as JSON lines ('-' for stdout)", "option", "J"), # type: ignore
+        full: ("Check every package of the groups, even if they were complete at the last sync", "flag", "F"), # type: ignore
         *groups: "Packages to validate or complete", # type: ignore
     ):
         cmd = pkg_cmd.PackageManagerMain(self.context)
-        cmd.sync(master, validate_only, signal_cts, self.quiet, lang, *groups)
+        cmd.sync(
+            master,
+            validate_only,
+            signal_cts,
+            self.quiet,
+            lang,
+            *groups,
+            workers=workers,
+            rate_limit=rate_limit,
+            verify=verify,
+            durability=durability,
+            processes=processes,
+            progress_json=progress_json,
+            full=full,
+        )
 
     def pkg_gc(
         self,
@@ -249,6 +298,24 @@ class ASToolMainCommand(object):
         cmd = pkg_cmd.PackageManagerMain(self.context)
         cmd.gc(master, dry_run, lang)
 
+    def pkg_dedupe(
+        self,
+        master: ("Assume master version (that you already have an asset DB for)", "option", "m"), # type: ignore
+        lang: ("Asset language (default: ja)", "option", "g"), # type: ignore
+    ):
+        cmd = pkg_cmd.PackageManagerMain(self.context)
+        cmd.dedupe(master, lang)
+
+    def pkg_promote(
+        self,
+        master: ("Assume master version (that you already have an asset DB for)", "option", "m"), # type: ignore
+        lang: ("Asset language (default: ja)", "option", "g"), # type: ignore
+        demote: ("Move the packages back to the main cache instead", "flag", "d"), # type: ignore
+        *groups: "Packages to move", # type: ignore
+    ):
+        cmd = pkg_cmd.PackageManagerMain(self.context)
+        cmd.promote(master, lang, demote, *groups)
+
     def master_gc(
         self,
         dry_run: ("Dry run. Don't delete any files.", "flag", "n"), # type: ignore
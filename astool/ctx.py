@@ -71,12 +71,17 @@ class ASContext(object):
 
         self.root = os.path.join(os.getenv("ASTOOL_STORAGE", ""), self.region)
         self.cache = os.path.join(self.root, "cache")
+        # Caches on faster storage, searched before the main one. Downloads still go to the main cache.
+        self.cache_roots = [
+            os.path.join(fast, self.region, "cache") for fast in os.getenv("ASTOOL_FAST_CACHE", "").split(os.pathsep) if fast
+        ] + [self.cache]
         self.masters = os.path.join(self.root, "masters")
         self.memo_full_path = os.path.join(self.root, f"{self.memo_name}.json")
 
         self.session = requests.Session()
 
-        os.makedirs(self.cache, exist_ok=True)
+        for cache in self.cache_roots:
+            os.makedirs(cache, exist_ok=True)
         os.makedirs(self.masters, exist_ok=True)
 
         if not self.bundle:
@@ -2,6 +2,7 @@
 # @(#)2016-2019, The Holy Constituency of the Summer Triangle.
 # @(#)All rights reserved.
 
+import asyncio
 import base64
 import json
 import time
@@ -25,6 +26,11 @@ from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 APIThunkLog = logging.getLogger("ICEAPIThunk")
 APIBinderLog = logging.getLogger("ICEBinder")
 
@@ -275,10 +281,13 @@ class ICEBinder(object):
 
     def extract_response(self, rsp):
         rsp.raise_for_status()
+        return self.parse_response(rsp.headers, rsp.content)
+
+    def parse_response(self, headers, body: bytes):
         try:
-            payload = rsp.json()
+            payload = json.loads(body)
         except json.JSONDecodeError:
-            return api_return_t(rsp.headers, -1, None, 0)
+            return api_return_t(headers, -1, None, 0)
 
         if os.environ.get("ICEAPI_DEBUG_RESPONSES"):
             pprint.pprint(payload)
@@ -287,14 +296,10 @@ class ICEBinder(object):
         self.master_version = payload[1]
         APIBinderLog.debug(f"IceAPI: Set master version to {self.master_version}!")
 
-        return api_return_t(rsp.headers, payload[2], payload[3], payload[0] / 1000)
-
-    def default_hit_api(
-        self, url, payload=None, skip_session_key_check=False, skip_fast_resume=False
-    ):
-        if not skip_session_key_check and not self.has_session:
-            raise ValueError("You need to establish a session before you do that.")
+        return api_return_t(headers, payload[2], payload[3], payload[0] / 1000)
 
+    def prepare_request(self, url, payload=None):
+        """Take the next request ID and sign the payload. Returns (URL, headers, body)."""
         headers = {}
         headers["User-Agent"] = self.user_agent
 
@@ -309,6 +314,16 @@ class ICEBinder(object):
         if os.environ.get("ICEAPI_DEBUG_REQUESTS"):
             pprint.pprint(data)
 
+        return destURL, headers, data
+
+    def default_hit_api(
+        self, url, payload=None, skip_session_key_check=False, skip_fast_resume=False
+    ):
+        if not skip_session_key_check and not self.has_session:
+            raise ValueError("You need to establish a session before you do that.")
+
+        destURL, headers, data = self.prepare_request(url, payload)
+
         if self.is_fast_resume_in_progress and not skip_fast_resume:
             master = self.master_version
             rsp = self.http_session.post(destURL, headers=headers, data=data)
@@ -347,20 +362,7 @@ class ICEBinder(object):
 
     def relogin_and_retry(self, url, payload):
         self.relogin()
-
-        headers = {}
-        headers["User-Agent"] = self.user_agent
-        q = self.query()
-
-        destURL = self.api_host.rstrip("/") + f"{url}?{q}"
-        destJSON = json.dumps(payload, separators=(",", ":"))
-
-        headers["Content-Type"] = "application/json"
-        data = self.bless(f"{url}?{q}", destJSON)
-
-        if os.environ.get("ICEAPI_DEBUG_REQUESTS"):
-            pprint.pprint(data)
-
+        destURL, headers, data = self.prepare_request(url, payload)
         return self.http_session.post(destURL, headers=headers, data=data)
 
     #####
@@ -446,3 +448,139 @@ class ICEBinder(object):
             url, params, skip_session_key_check=True, skip_fast_resume=True
         )
         return result
+
+
+class AsyncICEAPIThunk(ICEAPIThunk):
+    def __repr__(self):
+        return "<AsyncICEAPIThunk for url '{0}'>".format(self.url)
+
+    def __getattr__(self, attr):
+        return AsyncICEAPIThunk(self.session, "/".join((self.url, attr)))
+
+    async def __call__(self, *args, **kwargs):
+        APIThunkLog.debug("callout %s", self.url)
+
+        if self.url in ICEAPIThunk.special_behaviours:
+            ret = await self.session.call_sync(
+                ICEAPIThunk.special_behaviours[self.url], self.url, *args, **kwargs
+            )
+        else:
+            ret = await self.session.default_hit_api(self.url, *args, **kwargs)
+
+        APIThunkLog.debug("result: %s -> %d", self.url, ret.return_code)
+        return ret
+
+
+class AsyncICEBinder(object):
+    """
+    Sends API calls for a logged in ICEBinder with aiohttp, so several can be in flight at once.
+
+        async with AsyncICEBinder(ice, concurrency=4) as aice:
+            ret = await aice.api.userProfile.fetchProfile({"user_id": uid})
+
+    Every call goes through one keep-alive connection pool. The server expects request IDs
+    in order, so each request takes its ID and is written out while holding a lock; only
+    waiting for the responses happens concurrently. The ICEBinder keeps the session, so
+    it can be saved with save_session as usual afterwards.
+    """
+
+    def __init__(self, binder: ICEBinder, concurrency: int = 4):
+        if aiohttp is None:
+            raise RuntimeError("AsyncICEBinder needs aiohttp. Install astool[async_pkg].")
+
+        self.binder = binder
+        self.concurrency = max(1, concurrency)
+        # Made on first use, so they belong to the event loop that's running then.
+        self.http_session = None
+        self.slots: asyncio.Semaphore = None # type: ignore
+        self.send_lock: asyncio.Lock = None # type: ignore
+        # Bumped every time we log in again, so a pile of 403s only does it once.
+        self.generation = 0
+
+        self.api = AsyncICEAPIThunk(self, "")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    @property
+    def session(self):
+        return self
+
+    async def get_http_session(self):
+        if self.http_session is None:
+            trace = aiohttp.TraceConfig()
+            trace.on_request_chunk_sent.append(self._request_sent)
+            trace.on_request_end.append(self._request_sent)
+            trace.on_request_exception.append(self._request_sent)
+            self.http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                trace_configs=[trace],
+            )
+            self.slots = asyncio.Semaphore(self.concurrency)
+            self.send_lock = asyncio.Lock()
+        return self.http_session
+
+    @staticmethod
+    async def _request_sent(session, trace_config_ctx, params):
+        sent = trace_config_ctx.trace_request_ctx
+        if sent is not None:
+            sent.set()
+
+    async def close(self):
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
+
+    async def call_sync(self, func, *args, **kwargs):
+        """Run one of the ICEBinder's own calls (like login) in a thread, with nothing else being sent."""
+        await self.get_http_session()
+        loop = asyncio.get_event_loop()
+        async with self.send_lock:
+            ret = await loop.run_in_executor(None, lambda: func(self.binder, *args, **kwargs))
+            self.generation += 1
+        return ret
+
+    async def send(self, url, payload):
+        """Send a request once it has its ID, returning the response and the login it was sent with."""
+        http_session = await self.get_http_session()
+        async with self.send_lock:
+            generation = self.generation
+            destURL, headers, data = self.binder.prepare_request(url, payload)
+
+            sent = asyncio.Event()
+            request = asyncio.ensure_future(
+                http_session.post(destURL, headers=headers, data=data, trace_request_ctx=sent)
+            )
+            # Don't let the next request take an ID until this one is on the wire.
+            waiter = asyncio.ensure_future(sent.wait())
+            await asyncio.wait((request, waiter), return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+
+        return await request, generation
+
+    async def default_hit_api(self, url, payload=None):
+        if not self.binder.has_session:
+            raise ValueError("You need to establish a session before you do that.")
+
+        await self.get_http_session()
+        async with self.slots:
+            rsp, generation = await self.send(url, payload)
+            if rsp.status == 403:
+                rsp.release()
+                APIThunkLog.warning("The session has gone invalid.")
+                async with self.send_lock:
+                    if self.generation == generation:
+                        loop = asyncio.get_event_loop()
+                        await loop.run_in_executor(None, self.binder.relogin)
+                        self.generation += 1
+                rsp, _ = await self.send(url, payload)
+
+            async with rsp:
+                rsp.raise_for_status()
+                ret = self.binder.parse_response(rsp.headers, await rsp.read())
+
+        self.binder.is_fast_resume_in_progress = False
+        return ret
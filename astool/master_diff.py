@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# Compares the databases of two master versions.
+#
+# Databases whose encrypted SHA-1 is the same in both manifests are skipped. The rest are
+# ATTACHed to one connection and compared table by table in SQL, matching rows on the
+# table's primary key (or on the whole row if it doesn't have one), so only the rows that
+# changed ever get to Python.
+
+import os
+import json
+import sqlite3
+import logging
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from . import masters
+from .ctx import ASContext
+
+LOGGER = logging.getLogger("astool.master_diff")
+
+
+def quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+class JSONLinesWriter(object):
+    """Writes changes as one JSON object per line.
+
+    Databases get a line saying whether they were added, removed or changed. A table gets a
+    line with its columns and key before its first changed row, or right away if the table
+    itself was added or removed or its layout changed. Inserted rows carry all their values,
+    deleted ones only their key (the whole row if there is no key), and updated ones their
+    key and {column: [old, new]} for each column that changed.
+    """
+
+    def __init__(self, db: sqlite3.Connection, out: TextIO):
+        self.db = db
+        self.out = out
+        self.header: Optional[dict] = None
+
+    def emit(self, record: dict):
+        self.out.write(json.dumps(record, separators=(",", ":"), default=lambda b: b.hex()) + "\n")
+
+    def database(self, name: str, status: str):
+        self.emit({"db": name, "op": status})
+
+    def table(self, db: str, table: str, status: str, columns: List[str], key: List[str]):
+        self.header = {"db": db, "table": table, "op": status, "columns": columns, "key": key}
+        if status != "changed":
+            self.emit(self.header)
+            self.header = None
+
+    def rows(self, db: str, table: str, op: str, query: str, nkey: int = 0) -> int:
+        """Write the rows query returns as op. For updates, each row is the key, followed by
+        the new values and then the old values of the other columns."""
+        count = 0
+        cursor = self.db.execute(query)
+        names = [d[0] for d in cursor.description]
+        nvalues = (len(names) - nkey) // 2
+        for row in cursor:
+            if self.header:
+                self.emit(self.header)
+                self.header = None
+            count += 1
+
+            if op == "update":
+                new, old = row[nkey : nkey + nvalues], row[nkey + nvalues :]
+                changes = {names[nkey + i]: [o, n] for i, (n, o) in enumerate(zip(new, old)) if n != o}
+                self.emit({"db": db, "table": table, "op": op, "key": list(row[:nkey]), "changes": changes})
+            else:
+                self.emit({"db": db, "table": table, "op": op, "row": list(row)})
+        return count
+
+    def close(self):
+        self.out.flush()
+
+
+class SQLiteWriter(object):
+    """Copies the changes into an SQLite database, without going through Python.
+
+    A table with changes gets "db/table/insert", "db/table/delete" and "db/table/update"
+    tables in it, laid out like the rows JSONLinesWriter gets. Updated rows have the key, the
+    new values, and the old values in columns prefixed with old_. The changes table lists
+    everything that changed, with row counts.
+    """
+
+    def __init__(self, db: sqlite3.Connection, path: str):
+        self.db = db
+        db.execute("ATTACH DATABASE ? AS changeset", (path,))
+        db.execute("CREATE TABLE IF NOT EXISTS changeset.changes (db TEXT, tbl TEXT, op TEXT, count INTEGER)")
+
+    def database(self, name: str, status: str):
+        self.db.execute("INSERT INTO changeset.changes VALUES (?, NULL, ?, NULL)", (name, status))
+
+    def table(self, db: str, table: str, status: str, columns: List[str], key: List[str]):
+        if status != "changed":
+            self.db.execute("INSERT INTO changeset.changes VALUES (?, ?, ?, NULL)", (db, table, status))
+
+    def rows(self, db: str, table: str, op: str, query: str, nkey: int = 0) -> int:
+        name = "changeset." + quote(f"{db}/{table}/{op}")
+        self.db.execute(f"DROP TABLE IF EXISTS {name}")
+        self.db.execute(f"CREATE TABLE {name} AS {query}")
+        count = self.db.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+        if count:
+            self.db.execute("INSERT INTO changeset.changes VALUES (?, ?, ?, ?)", (db, table, op, count))
+        else:
+            self.db.execute(f"DROP TABLE {name}")
+        return count
+
+    def close(self):
+        self.db.commit()
+
+
+def table_layout(db: sqlite3.Connection, schema: str, table: str) -> Tuple[List[str], List[str]]:
+    """The columns and primary key columns of a table."""
+    info = db.execute(f"PRAGMA {schema}.table_info({quote(table)})").fetchall()
+    columns = [row[1] for row in info]
+    key = [row[1] for row in sorted((row for row in info if row[5]), key=lambda row: row[5])]
+    return columns, key
+
+
+def list_tables(db: sqlite3.Connection, schema: str) -> List[str]:
+    return [
+        name
+        for name, in db.execute(
+            f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        )
+    ]
+
+
+def diff_table(db: sqlite3.Connection, writer, db_name: str, table: str) -> Dict[str, int]:
+    """Compare old.table with new.table. Returns the number of rows for each kind of change."""
+    old_columns, old_key = table_layout(db, "old", table)
+    new_columns, new_key = table_layout(db, "new", table)
+    columns = [c for c in new_columns if c in old_columns]
+    key = new_key if new_key == old_key else []
+    status = "changed" if (old_columns, old_key) == (new_columns, new_key) else "layout_changed"
+    writer.table(db_name, table, status, columns, key)
+
+    new, old = f"new.{quote(table)}", f"old.{quote(table)}"
+    counts = {}
+    if not key:
+        # All we can tell is which whole rows are new and which are gone.
+        select = ", ".join(quote(c) for c in columns)
+        counts["insert"] = writer.rows(db_name, table, "insert", f"SELECT {select} FROM {new} EXCEPT SELECT {select} FROM {old}")
+        counts["delete"] = writer.rows(db_name, table, "delete", f"SELECT {select} FROM {old} EXCEPT SELECT {select} FROM {new}")
+        return counts
+
+    on = " AND ".join(f"n.{quote(c)} = o.{quote(c)}" for c in key)
+    counts["insert"] = writer.rows(
+        db_name,
+        table,
+        "insert",
+        f"SELECT {', '.join('n.' + quote(c) for c in columns)} FROM {new} n WHERE NOT EXISTS (SELECT 1 FROM {old} o WHERE {on})",
+    )
+    counts["delete"] = writer.rows(
+        db_name,
+        table,
+        "delete",
+        f"SELECT {', '.join('o.' + quote(c) for c in key)} FROM {old} o WHERE NOT EXISTS (SELECT 1 FROM {new} n WHERE {on})",
+    )
+
+    values = [c for c in columns if c not in key]
+    if values:
+        select = (
+            ["n." + quote(c) for c in key]
+            + [f"n.{quote(c)} AS {quote(c)}" for c in values]
+            + [f"o.{quote(c)} AS {quote('old_' + c)}" for c in values]
+        )
+        differs = " OR ".join(f"n.{quote(c)} IS NOT o.{quote(c)}" for c in values)
+        counts["update"] = writer.rows(
+            db_name,
+            table,
+            "update",
+            f"SELECT {', '.join(select)} FROM {new} n JOIN {old} o ON {on} WHERE {differs}",
+            nkey=len(key),
+        )
+    return counts
+
+
+def diff_database(db: sqlite3.Connection, writer, db_name: str, old_path: Optional[str], new_path: str):
+    """Compare two versions of a database. old_path is None if the database is new.
+    Returns {table: {kind of change: rows}} for the tables that changed."""
+    # An empty in-memory database makes every table count as added.
+    db.execute("ATTACH DATABASE ? AS old", (f"file:{old_path}?mode=ro" if old_path else ":memory:",))
+    db.execute("ATTACH DATABASE ? AS new", (f"file:{new_path}?mode=ro",))
+    summary: Dict[str, Dict[str, int]] = {}
+    try:
+        old_tables, new_tables = set(list_tables(db, "old")), set(list_tables(db, "new"))
+        for table in sorted(new_tables - old_tables):
+            columns, key = table_layout(db, "new", table)
+            writer.table(db_name, table, "added", columns, key)
+            summary[table] = {"insert": writer.rows(db_name, table, "insert", f"SELECT * FROM new.{quote(table)}")}
+
+        for table in sorted(old_tables - new_tables):
+            columns, key = table_layout(db, "old", table)
+            writer.table(db_name, table, "removed", columns, key)
+            summary[table] = {"delete": db.execute(f"SELECT COUNT(*) FROM old.{quote(table)}").fetchone()[0]}
+
+        for table in sorted(old_tables & new_tables):
+            counts = diff_table(db, writer, db_name, table)
+            if any(counts.values()):
+                summary[table] = counts
+    finally:
+        db.commit()
+        db.execute("DETACH DATABASE old")
+        db.execute("DETACH DATABASE new")
+    return summary
+
+
+def load_file_list(context: ASContext, version: str, langs: List[str]) -> Dict[str, masters.FileReference]:
+    files: Dict[str, masters.FileReference] = {}
+    for lang_code in langs:
+        manifest = masters.download_remote_manifest(context, version, lang_code=lang_code)
+        if manifest is None:
+            raise FileNotFoundError(f"Can't get the {lang_code} manifest for master {version}.")
+        for file in manifest.files:
+            files.setdefault(file.name, file)
+    return files
+
+
+def decrypted_path(context: ASContext, file: masters.FileReference) -> str:
+    """Path of the decrypted database, decrypting it again if master_gc removed it."""
+    local_store = os.path.join(context.masters, file.version)
+    path = os.path.join(local_store, file.name)
+    if not os.path.exists(path):
+        enc_path = os.path.join(local_store, "enc", file.name)
+        if not os.path.exists(enc_path):
+            raise FileNotFoundError(f"{file.name} of master {file.version} is missing, run dl_master -m {file.version}.")
+        LOGGER.info("Decrypting %s of master %s again...", file.name, file.version)
+        masters.decrypt_local(file, enc_path, local_store)
+    return path
+
+
+def diff_versions(context: ASContext, old_version: str, new_version: str, langs: List[str], make_writer):
+    """Compare the databases of two master versions. make_writer is called with the
+    connection the comparison runs on and returns a JSONLinesWriter or SQLiteWriter.
+    Returns {database: {table: {kind of change: rows}}} for the databases that changed."""
+    old_files = load_file_list(context, old_version, langs)
+    new_files = load_file_list(context, new_version, langs)
+
+    db = sqlite3.connect(":memory:", uri=True)
+    writer = make_writer(db)
+    summary: Dict[str, Dict[str, Dict[str, int]]] = {}
+    try:
+        for name in sorted(set(old_files) | set(new_files)):
+            old, new = old_files.get(name), new_files.get(name)
+            if new is None:
+                writer.database(name, "removed")
+                summary[name] = {}
+            elif old is not None and old.encrypted_sha == new.encrypted_sha:
+                LOGGER.debug("%s hasn't changed.", name)
+            else:
+                LOGGER.info("Comparing %s...", name)
+                writer.database(name, "changed" if old else "added")
+                old_path = decrypted_path(context, old) if old else None
+                summary[name] = diff_database(db, writer, name, old_path, decrypted_path(context, new))
+    finally:
+        writer.close()
+        db.close()
+    return summary
@@ -14,19 +14,34 @@ import json
 import struct
 import binascii
 import tempfile
-import zlib
+import shutil
 import io
 import logging
 import hashlib
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import requests
 
 from .sv_config import ServerConfiguration
 from .ctx import ASContext
 import hwdecrypt
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # Thanks to esterTion and CPPO for help
 
 LOGGER = logging.getLogger("astool.masters")
 
+DOWNLOAD_WORKERS = 4
+# ioctl to make dest share src's data on filesystems that support it (btrfs, XFS, ...).
+FICLONE = 0x40049409
+
 
 def eatbytes(stream, n):
     return stream.read(n)
@@ -127,37 +142,177 @@ def download_remote_manifest(
     return Manifest(io.BytesIO(r.content), context.server_config)
 
 
-def file_is_valid(context: ASContext, file: FileReference):
+class HashCache(object):
+    """Remembers the SHA-1 of a master version's encrypted files, along with the size and
+    mtime they had when it was computed, so unchanged files don't have to be read again.
+    Files that were decrypted also get the keys that were used."""
+
+    FILENAME = "sha_cache.json"
+
+    def __init__(self, context: ASContext, version: str):
+        self.enc_dir = os.path.join(context.masters, version, "enc")
+        self.path = os.path.join(self.enc_dir, self.FILENAME)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def lookup(self, name: str) -> Optional[str]:
+        try:
+            st = os.stat(os.path.join(self.enc_dir, name))
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry and entry[:2] == [st.st_size, st.st_mtime_ns]:
+            return entry[2]
+        return None
+
+    def record(self, name: str, sha: str, keys: Optional[List[int]] = None):
+        st = os.stat(os.path.join(self.enc_dir, name))
+        with self.lock:
+            self.entries[name] = [st.st_size, st.st_mtime_ns, sha, keys]
+
+    def copies(self) -> Iterable[Tuple[str, str, Optional[List[int]]]]:
+        """(name, SHA-1, keys) of every file whose entry is still up to date."""
+        for name in list(self.entries):
+            sha = self.lookup(name)
+            if sha:
+                entry = self.entries[name]
+                yield name, sha, entry[3] if len(entry) > 3 else None
+
+    def save(self):
+        os.makedirs(self.enc_dir, exist_ok=True)
+        with self.lock, open(self.path, "w") as f:
+            json.dump(self.entries, f)
+
+
+def file_is_valid(context: ASContext, file: FileReference, hashes: Optional[HashCache] = None):
     local_store = os.path.join(context.masters, file.version)
 
     p = os.path.join(local_store, "enc", file.name)
     if not os.path.exists(p):
         return False
 
+    if hashes:
+        known = hashes.lookup(file.name)
+        if known:
+            return known == file.encrypted_sha
+
     h = hashlib.sha1()
     with open(p, "rb") as stream:
         while 1:
-            chunk = stream.read(0x4000)
+            chunk = stream.read(0x10000)
             if not chunk:
                 break
             h.update(chunk)
 
+    if hashes:
+        hashes.record(file.name, h.hexdigest())
     if file.encrypted_sha == h.hexdigest():
         return True
     return False
 
 
-def download_one(context: ASContext, file: FileReference):
+def decrypt_local(file: FileReference, enc_path: str, local_store: str):
+    """Decrypt the encrypted copy of file at enc_path into local_store."""
+    ks = file.getkeys()
+    stream = hwdecrypt.MasterStream(hwdecrypt.Keyset(ks[0], ks[1], ks[2]))
+    clear_fd = tempfile.NamedTemporaryFile("wb", dir=local_store, prefix="._astool_temp", delete=False)
+    with open(enc_path, "rb") as enc, clear_fd:
+        while True:
+            chunk = enc.read(0x10000)
+            if not chunk:
+                break
+            clear_fd.write(stream.decompress(chunk))
+        clear_fd.write(stream.flush())
+    os.chmod(clear_fd.name, 0o644)
+    os.replace(clear_fd.name, os.path.join(local_store, file.name))
+
+
+PreviousCopy = Tuple[str, str, Optional[List[int]]]
+
+
+def find_previous_copies(context: ASContext, version: str) -> Dict[str, PreviousCopy]:
+    """Map the encrypted SHA-1s of the files other master versions have to
+    (version directory, name, keys they were decrypted with)."""
+    found: Dict[str, PreviousCopy] = {}
+    for other in os.listdir(context.masters):
+        path = os.path.join(context.masters, other)
+        if other == version or os.path.islink(path) or not os.path.isdir(os.path.join(path, "enc")):
+            continue
+
+        for name, sha, keys in HashCache(context, other).copies():
+            found.setdefault(sha, (path, name, keys))
+    return found
+
+
+def clone_file(src: str, dest: str):
+    """Make dest a copy of src that takes no extra space if possible: a reflink, or a hard
+    link if the filesystem can't do those."""
+    tmp_fd = tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(dest), prefix="._astool_temp", delete=False)
+    cloned = False
+    with tmp_fd:
+        if fcntl:
+            try:
+                with open(src, "rb") as sf:
+                    fcntl.ioctl(tmp_fd.fileno(), FICLONE, sf.fileno())
+                cloned = True
+            except OSError:
+                pass
+
+    if cloned:
+        os.chmod(tmp_fd.name, 0o644)
+    else:
+        os.unlink(tmp_fd.name)
+        try:
+            os.link(src, tmp_fd.name)
+        except OSError:
+            shutil.copyfile(src, tmp_fd.name)
+    os.replace(tmp_fd.name, dest)
+
+
+def reuse_previous(context: ASContext, file: FileReference, previous: PreviousCopy, hashes: Optional[HashCache] = None):
+    """Put a copy of file that another master version already has into this version."""
+    local_store = os.path.join(context.masters, file.version)
+    src_dir, src_name, src_keys = previous
+    os.makedirs(os.path.join(local_store, "enc"), exist_ok=True)
+    src_enc = os.path.join(src_dir, "enc", src_name)
+    src_clear = os.path.join(src_dir, src_name)
+
+    ks = file.getkeys()
+    if src_keys == ks and os.path.exists(src_clear):
+        clone_file(src_clear, os.path.join(local_store, file.name))
+    else:
+        # The decrypted copy is gone (master_gc) or used other keys, but there's no need
+        # to download the encrypted data again.
+        decrypt_local(file, src_enc, local_store)
+
+    # Encrypted file last, like in download_one.
+    clone_file(src_enc, os.path.join(local_store, "enc", file.name))
+    if hashes:
+        hashes.record(file.name, file.encrypted_sha, ks)
+
+
+def download_one(
+    context: ASContext,
+    file: FileReference,
+    hashes: Optional[HashCache] = None,
+    session: Optional[requests.Session] = None,
+):
     local_store = os.path.join(context.masters, file.version)
     remote_root = context.server_config["root"] + f"/static/{file.version}"
 
-    rf = context.session.get(
-        f"{remote_root}/{file.name}", headers={"User-Agent": context.server_config["user_agent"]}
+    rf = (session or context.session).get(
+        f"{remote_root}/{file.name}", headers={"User-Agent": context.server_config["user_agent"]}, stream=True
     )
+    rf.raise_for_status()
 
     ks = file.getkeys()
-    keys = hwdecrypt.Keyset(ks[0], ks[1], ks[2])
-    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    stream = hwdecrypt.MasterStream(hwdecrypt.Keyset(ks[0], ks[1], ks[2]))
 
     os.makedirs(os.path.join(local_store, "enc"), exist_ok=True)
 
@@ -167,14 +322,27 @@ def download_one(context: ASContext, file: FileReference):
     enc_fd = tempfile.NamedTemporaryFile("wb", dir=local_store, prefix="._astool_temp", delete=False)
     clear_fd = tempfile.NamedTemporaryFile("wb", dir=local_store, prefix="._astool_temp", delete=False)
 
-    with enc_fd, clear_fd:
-        for chunk in rf.iter_content(chunk_size=0x4000):
-            enc_fd.write(chunk)
-            copy = bytearray(chunk)
-            hwdecrypt.decrypt(keys, copy)
-            clear_fd.write(decompressor.decompress(copy))
-        clear_fd.write(decompressor.flush())
-    
+    h = hashlib.sha1()
+    try:
+        with rf, enc_fd, clear_fd:
+            try:
+                for chunk in rf.iter_content(chunk_size=0x10000):
+                    h.update(chunk)
+                    enc_fd.write(chunk)
+                    clear_fd.write(stream.decompress(chunk))
+                clear_fd.write(stream.flush())
+            except zlib.error as e:
+                raise ValueError(f"{file.name} was corrupted while downloading ({e}).") from e
+
+        if h.hexdigest() != file.encrypted_sha:
+            raise ValueError(
+                f"{file.name} was corrupted while downloading (SHA-1 {h.hexdigest()}, expected {file.encrypted_sha})."
+            )
+    except BaseException:
+        os.unlink(enc_fd.name)
+        os.unlink(clear_fd.name)
+        raise
+
     # Order is important here because file_is_valid only checks the status of the encrypted file.
     os.chmod(clear_fd.name, 0o644)
     try:
@@ -190,6 +358,51 @@ def download_one(context: ASContext, file: FileReference):
         pass
     os.rename(enc_fd.name, dest_enc_filename)
 
+    if hashes:
+        hashes.record(file.name, file.encrypted_sha, ks)
+
+
+def download_files(
+    context: ASContext, version: str, files: Iterable[FileReference], force=False, workers=DOWNLOAD_WORKERS
+):
+    """Check and download a master version's files, workers at a time. Files that another
+    version already has are copied from there instead, unless force is set."""
+    hashes = HashCache(context, version)
+    previous = {} if force else find_previous_copies(context, version)
+    # requests.Session isn't safe to share between threads, so each worker gets its own.
+    sessions: List[requests.Session] = []
+    local = threading.local()
+
+    def thread_session() -> requests.Session:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            sessions.append(local.session)
+        return local.session
+
+    def sync_file(file: FileReference):
+        if not force and file_is_valid(context, file, hashes):
+            LOGGER.info("File %s is still valid!", file.name)
+            return
+
+        if file.encrypted_sha in previous:
+            LOGGER.info("Reusing %s from %s...", file.name, os.path.basename(previous[file.encrypted_sha][0]))
+            reuse_previous(context, file, previous[file.encrypted_sha], hashes)
+            return
+
+        LOGGER.info("Retrieving and decrypting %s...", file.name)
+        download_one(context, file, hashes, thread_session())
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Collect every result so the first error is raised after the rest are finished.
+            for future in [executor.submit(sync_file, file) for file in files]:
+                future.result()
+    finally:
+        hashes.save()
+        for session in sessions:
+            session.close()
+
+
 def update_current_link(context: ASContext, master: str):
     sym_path = os.path.join(context.masters, "current")
     if os.path.exists(sym_path) and not os.path.islink(sym_path):
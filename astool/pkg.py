@@ -1,17 +1,30 @@
 #!/usr/bin/env python3
 import sqlite3
 import os
-import io
+import sys
+import ctypes
+import errno
+import shutil
 import logging
 import asyncio
 import time
-import tempfile
-from typing import Optional, Set, Iterable, Union, Tuple, List
+import json
+import itertools
+import heapq
+import queue
+import threading
+import traceback
+import multiprocessing
+from typing import Optional, Set, Iterable, Union, Tuple, List, Dict
 from collections import namedtuple
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, Future
 
 import requests
 
+from .progress import DownloadProgress
+from .pkgstore import PackageStore, hash_file
+
 try:
     import aiohttp
 except ImportError:
@@ -46,28 +59,708 @@ def execution_timer(name):
     logging.info("%s: %f s", name, time.monotonic() - t)
 
 
+PACKAGE_PREFIXES = "0123456789abcdefghijklmnopqrstuvwxyz"
+# Downloads at least this big keep a journal next to their staging file so they can be resumed.
+RESUME_MIN_SIZE = 0x100000
+# Partial downloads that haven't been touched for this long are deleted.
+PARTIAL_MAX_AGE = 7 * 86400
+PARTIAL_ORPHAN_AGE = 3600
+# A download is tried this many times before the sync gives up.
+DOWNLOAD_ATTEMPTS = 3
+# The requests-based downloader waits this long before its first retry, doubling each time.
+RETRY_DELAY = 2.0
+# (connect, read) timeouts for the requests-based downloader, like the aiohttp one's.
+REQUEST_TIMEOUT = (30, 60)
+# Missing splits of a metapackage closer together than this are fetched with one request.
+COALESCE_GAP = 0x40000
+# Stat'ing is mostly waiting on the disk, so use more threads than cores.
+VERIFY_THREADS = min(32, (os.cpu_count() or 1) * 4)
+DURABILITY_LEVELS = ("none", "batch", "file")
+# Bodies are read in chunks of this size, and staging files are written through a buffer this big.
+READ_CHUNK = 0x40000
+WRITE_BUFFER = 0x100000
+FALLOC_FL_KEEP_SIZE = 1
+
+
+def download_task_size(task: AnyDownloadTask) -> int:
+    if task.is_meta:
+        return sum(split.size for split in task.splits)
+    return task.size
+
+
+class BandwidthLimiter(object):
+    """Token bucket shared by all download workers. A rate of 0 or None means no limit."""
+
+    def __init__(self, rate: Optional[int]):
+        self.rate = rate
+        self.allowance = rate or 0
+        self.last = time.monotonic()
+
+    def delay(self, nbytes: int) -> float:
+        """Account for nbytes just transferred and return how long to sleep before the next read."""
+        if not self.rate:
+            return 0
+
+        now = time.monotonic()
+        self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate) - nbytes
+        self.last = now
+        if self.allowance < 0:
+            return -self.allowance / self.rate
+        return 0
+
+
+class PackURLSigner(object):
+    """Gets download URLs for packages from the API, in batches.
+
+    All batches are queued on one thread as soon as the signer is created (ICEBinder
+    isn't thread safe), so downloading can start after the first one comes back.
+    batches is a list of futures, each resolving to a list of (job, url). Once
+    the last batch is signed the session is passed to done, if there is one. URLs that
+    expire during the download can be re-signed with resign(), which goes ahead of any
+    batches still waiting. If the session has already been handed off, a new one is
+    taken from reacquire, a callable returning a context manager that yields an
+    ICEBinder. Without reacquire, re-signing after the handoff fails.
+    """
+
+    BATCH_SIZE = 1000
+    # Lower runs first.
+    PRIORITY_RESIGN = 0
+    PRIORITY_BATCH = 1
+
+    def __init__(self, ice, jobs: List[AnyDownloadTask], done=None, reacquire=None):
+        self.ice = ice
+        self.user_agent = ice.user_agent
+        self.done = done
+        self.reacquire = reacquire
+        self.exit_stack = ExitStack()
+        self.tasks: queue.PriorityQueue = queue.PriorityQueue()
+        self.seq = itertools.count()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        # Sign the biggest jobs first so the scheduler has them early.
+        jobs = sorted(jobs, key=download_task_size, reverse=True)
+        self.batches = []
+        for i in range(0, len(jobs), self.BATCH_SIZE):
+            self.batches.append(self.submit(self.PRIORITY_BATCH, self.sign_jobs, jobs[i : i + self.BATCH_SIZE]))
+        self.submit(self.PRIORITY_BATCH, self.hand_off)
+
+    def submit(self, priority: int, fn, *args) -> Future:
+        future: Future = Future()
+        self.tasks.put((priority, next(self.seq), future, fn, args))
+        return future
+
+    def run(self):
+        while True:
+            _, _, future, fn, args = self.tasks.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def sign_jobs(self, jobs: List[AnyDownloadTask]) -> List[Tuple[AnyDownloadTask, str]]:
+        return list(zip(jobs, self.sign([job.name for job in jobs])))
+
+    def sign(self, names: List[str]) -> List[str]:
+        url_list = self.ice.api.asset.getPackUrl({"pack_names": names})
+        if url_list.return_code != 0:
+            raise ValueError("Failed to get the url list!")
+
+        url_list = url_list.app_data["url_list"]
+        assert len(url_list) == len(names)
+        return url_list
+
+    def hand_off(self):
+        # Without done the session stays ours, so expired URLs can still be re-signed with it.
+        if self.done:
+            self.done(self.ice)
+            self.ice = None
+
+    def _resign(self, name: str) -> str:
+        if self.ice is None:
+            if not self.reacquire:
+                raise ValueError(f"The URL for {name} expired and there's no session to sign it again.")
+            self.ice = self.exit_stack.enter_context(self.reacquire())
+        return self.sign([name])[0]
+
+    def resign(self, name: str) -> Future:
+        return self.submit(self.PRIORITY_RESIGN, self._resign, name)
+
+    def close(self):
+        # Batches nobody is going to download don't need signing, but hand_off still has to run.
+        for future in self.batches:
+            future.cancel()
+        # Queued behind hand_off, so this stops the thread once everything else is done.
+        self.tasks.put((self.PRIORITY_BATCH, next(self.seq), None, None, ()))
+        self.thread.join()
+        self.exit_stack.close()
+
+
+class ShardFeed(object):
+    """Stands in for PackURLSigner inside a download worker process.
+
+    Jobs and re-signed URLs arrive from the parent through jobs_in; finished files and
+    requests to re-sign go back through results_out. See PackageManager.download_sharded.
+    """
+
+    def __init__(self, shard: int, jobs_in, results_out, user_agent: str):
+        self.shard = shard
+        self.jobs_in = jobs_in
+        self.results_out = results_out
+        self.user_agent = user_agent
+        self.incoming: queue.Queue = queue.Queue()
+        self.resigning: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    def receive(self):
+        # Keeps running after "end", the parent may still answer re-signing requests.
+        while True:
+            message = self.jobs_in.get()
+            if message[0] == "url":
+                with self.lock:
+                    future = self.resigning.pop(message[1])
+                future.set_result(message[2])
+            elif message[0] == "jobs":
+                self.incoming.put(message[1])
+            else:
+                self.incoming.put([])
+
+    @property
+    def batches(self):
+        while True:
+            future = self.executor.submit(self.incoming.get)
+            yield future
+            # An empty batch means there won't be any more.
+            if not future.result():
+                return
+
+    def resign(self, name: str) -> Future:
+        future: Future = Future()
+        with self.lock:
+            self.resigning[name] = future
+        self.results_out.put(("expired", self.shard, name))
+        return future
+
+    def publish(self, batch: List[Tuple[str, str]]):
+        self.results_out.put(("files", self.shard, batch))
+
+    def send_progress(self, snapshot: dict):
+        self.results_out.put(("progress", self.shard, snapshot))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class DownloadScheduler(object):
+    """Hands out download jobs, largest first, and decides how many workers should run.
+
+    With a fixed worker count this is just a priority queue. Otherwise it starts at
+    START_WORKERS and adds workers as long as each step raises throughput by at least
+    RAMP_GAIN; once it stops helping, the last step is undone and another step is only
+    tried after PROBE_INTERVAL samples. A failed request halves the worker count.
+    """
+
+    START_WORKERS = 8
+    MIN_WORKERS = 2
+    MAX_WORKERS = 64
+    SAMPLE_INTERVAL = 2.0
+    RAMP_GAIN = 1.1
+    PROBE_INTERVAL = 15
+
+    def __init__(self, workers: Optional[int] = None, rate_limit: Optional[int] = None):
+        if workers:
+            self.min_workers = self.max_workers = self.target = workers
+        else:
+            self.min_workers, self.max_workers = self.MIN_WORKERS, self.MAX_WORKERS
+            self.target = self.START_WORKERS
+
+        self.queue: list = []
+        self.seq = 0
+        self.limiter = BandwidthLimiter(rate_limit)
+        self.active = 0
+        self.transferred = 0
+        self.sample_bytes = 0
+        self.sample_time = time.monotonic()
+        self.best_rate = 0.0
+        self.last_step = 0
+        self.hold = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, job, url):
+        heapq.heappush(self.queue, (-download_task_size(job), self.seq, job, url, 0))
+        self.seq += 1
+
+    def next_job(self):
+        """Returns (job, url, attempt), or None if the calling worker should stop."""
+        if not self.queue or self.active > self.target:
+            return None
+        _, _, job, url, attempt = heapq.heappop(self.queue)
+        return job, url, attempt
+
+    def retry(self, job, url, attempt: int, backoff: bool = True):
+        heapq.heappush(self.queue, (-download_task_size(job), -1, job, url, attempt + 1))
+        if backoff and self.max_workers > self.min_workers:
+            self.target = max(self.min_workers, self.target // 2)
+            self.best_rate = 0.0
+            self.last_step = 0
+            self.hold = self.PROBE_INTERVAL
+
+    def record(self, nbytes: int) -> float:
+        """Count bytes received. Returns how long to sleep to stay under the rate limit."""
+        self.transferred += nbytes
+        return self.limiter.delay(nbytes)
+
+    def sample(self):
+        now = time.monotonic()
+        if now - self.sample_time < self.SAMPLE_INTERVAL:
+            return
+
+        rate = (self.transferred - self.sample_bytes) / (now - self.sample_time)
+        self.sample_bytes = self.transferred
+        self.sample_time = now
+        if self.max_workers == self.min_workers:
+            return
+
+        if self.hold:
+            self.hold -= 1
+            return
+
+        if rate > self.best_rate * self.RAMP_GAIN:
+            self.best_rate = rate
+        elif self.last_step:
+            # The last step didn't help. Go back and stay there for a while.
+            self.target -= self.last_step
+            self.last_step = 0
+            self.best_rate = rate
+            self.hold = self.PROBE_INTERVAL
+            LOGGER.debug("Throughput %d B/s with %d workers, holding.", rate, self.target)
+            return
+
+        self.last_step = min(max(1, self.target // 4), self.max_workers - self.target)
+        self.target += self.last_step
+        LOGGER.debug("Throughput %d B/s, trying %d workers.", rate, self.target)
+
+
+class PackageIndex(object):
+    """Remembers the contents of a package cache root between runs.
+
+    Each pkgX directory's mtime is stored along with the names, sizes and mtimes of the
+    packages in it. When loading, a directory whose mtime hasn't changed is taken from the
+    index; otherwise it's listed again and only the new names are stat'd. Changes made
+    through PackageManager are recorded as they happen, so they don't force a rescan.
+    """
+
+    FILENAME = "pkg_index.db"
+
+    def __init__(self, root: str):
+        self.root = root
+        self.path = os.path.join(root, self.FILENAME)
+        os.makedirs(root, exist_ok=True)
+        try:
+            self.db = self.open_db(self.path)
+        except sqlite3.DatabaseError:
+            LOGGER.warning("Package index at %s is unreadable, rebuilding it.", self.path)
+            os.unlink(self.path)
+            self.db = self.open_db(self.path)
+
+    @staticmethod
+    def open_db(path: str) -> sqlite3.Connection:
+        db = sqlite3.connect(path)
+        # Losing the tail of the index only means some directories get rescanned.
+        db.execute("PRAGMA synchronous = OFF")
+        db.execute("CREATE TABLE IF NOT EXISTS dirs (dir TEXT PRIMARY KEY, mtime_ns INTEGER)")
+        db.execute(
+            """CREATE TABLE IF NOT EXISTS packages (name TEXT PRIMARY KEY, dir TEXT,
+                size INTEGER, mtime_ns INTEGER)"""
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS packages_dir ON packages (dir)")
+        # Size and mtime of packages as they were when they last passed verification.
+        db.execute("CREATE TABLE IF NOT EXISTS verified (name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)")
+        db.commit()
+        return db
+
+    def dir_mtime(self, pkg_dir: str) -> Optional[int]:
+        row = self.db.execute("SELECT mtime_ns FROM dirs WHERE dir = ?", (pkg_dir,)).fetchone()
+        return row[0] if row else None
+
+    def directory_in_sync(self, pkg_dir: str) -> bool:
+        try:
+            return self.dir_mtime(pkg_dir) == os.stat(os.path.join(self.root, pkg_dir)).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def rescan(self, pkg_dir: str, letter: str, mtime_ns: int) -> Set[str]:
+        full_dir = os.path.join(self.root, pkg_dir)
+        on_disk = set(x for x in os.listdir(full_dir) if x.startswith(letter))
+        known = set(name for name, in self.db.execute("SELECT name FROM packages WHERE dir = ?", (pkg_dir,)))
+
+        self.db.executemany("DELETE FROM packages WHERE name = ?", ((x,) for x in known - on_disk))
+        new_rows = []
+        for name in on_disk - known:
+            try:
+                st = os.stat(os.path.join(full_dir, name))
+            except FileNotFoundError:
+                on_disk.discard(name)
+                continue
+            new_rows.append((name, pkg_dir, st.st_size, st.st_mtime_ns))
+        self.db.executemany("INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?)", new_rows)
+        self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (pkg_dir, mtime_ns))
+        return on_disk
+
+    def load(self) -> Set[str]:
+        packages: Set[str] = set()
+        rescanned = 0
+        for letter in PACKAGE_PREFIXES:
+            pkg_dir = f"pkg{letter}"
+            full_dir = os.path.join(self.root, pkg_dir)
+            try:
+                mtime_ns = os.stat(full_dir).st_mtime_ns
+            except FileNotFoundError:
+                os.makedirs(full_dir, exist_ok=True)
+                mtime_ns = os.stat(full_dir).st_mtime_ns
+
+            if self.dir_mtime(pkg_dir) == mtime_ns:
+                packages.update(name for name, in self.db.execute("SELECT name FROM packages WHERE dir = ?", (pkg_dir,)))
+            else:
+                packages.update(self.rescan(pkg_dir, letter, mtime_ns))
+                rescanned += 1
+
+        self.db.commit()
+        LOGGER.debug("Package index %s: %d directories rescanned.", self.path, rescanned)
+        return packages
+
+    @contextmanager
+    def changing(self, pkg_dir: str):
+        """Wrap anything that adds or removes entries in pkg_dir.
+
+        The directory's recorded mtime is only moved forward if nothing else had changed the
+        directory before we did. Otherwise it's left stale so the next load rescans it.
+        """
+        was_in_sync = self.directory_in_sync(pkg_dir)
+        yield
+        if was_in_sync:
+            mtime_ns = os.stat(os.path.join(self.root, pkg_dir)).st_mtime_ns
+            self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (pkg_dir, mtime_ns))
+
+        # Commit right away (it's cheap without syncing) so other processes aren't locked out.
+        self.commit()
+
+    def record_added(self, name: str):
+        pkg_dir = f"pkg{name[0]}"
+        st = os.stat(os.path.join(self.root, pkg_dir, name))
+        self.db.execute(
+            "INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?)", (name, pkg_dir, st.st_size, st.st_mtime_ns)
+        )
+
+    def record_removed(self, name: str):
+        self.db.execute("DELETE FROM packages WHERE name = ?", (name,))
+        self.db.execute("DELETE FROM verified WHERE name = ?", (name,))
+
+    def verified_stats(self) -> Dict[str, Tuple[int, int]]:
+        return {name: (size, mtime_ns) for name, size, mtime_ns in self.db.execute("SELECT * FROM verified")}
+
+    def record_verified(self, good: Iterable[Tuple[str, int, int]], bad: Iterable[str]):
+        self.db.executemany("INSERT OR REPLACE INTO verified VALUES (?, ?, ?)", good)
+        self.db.executemany("DELETE FROM verified WHERE name = ?", ((name,) for name in bad))
+        self.commit()
+
+    def lookup_size(self, name: str) -> Optional[int]:
+        row = self.db.execute("SELECT size FROM packages WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def _load_syncfs():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+
+
+SYNCFS = _load_syncfs()
+
+
+def _load_fallocate():
+    if not sys.platform.startswith("linux"):
+        return None
+    libc = ctypes.CDLL(None, use_errno=True)
+    fallocate = getattr(libc, "fallocate64", None) or getattr(libc, "fallocate", None)
+    if fallocate:
+        fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    return fallocate
+
+
+FALLOCATE = _load_fallocate()
+
+
+def preallocate(fd: int, offset: int, length: int):
+    """Reserve disk space for the rest of a file so it's laid out in one piece.
+
+    The file's size isn't changed: the staged length is how much of a download we have,
+    so posix_fallocate (which extends the file) can't be used. Filesystems that can't do
+    this are ignored.
+    """
+    if FALLOCATE and length > 0:
+        FALLOCATE(fd, FALLOC_FL_KEEP_SIZE, offset, length)
+
+
+fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+def fsync_directory(path: str):
+    # Directories can't be opened (or synced) on Windows.
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class CommitStage(object):
+    """Moves finished downloads from the staging directory into the cache.
+
+    durability is one of:
+    - none: files are renamed into place as soon as they're done and never synced. A crash
+      can leave empty or short packages behind.
+    - batch: finished files are collected until there are BATCH_FILES of them, BATCH_BYTES
+      of data or they're BATCH_DELAY seconds old. Then their data is synced in one go
+      (syncfs on Linux, fdatasync on each file elsewhere), they're renamed, and each pkgX
+      directory they went into is synced once.
+    - file: like batch, but every file is synced and published on its own.
+
+    publish is called with a list of (staged path, destination) pairs to do the renaming.
+    If digest is given, it's called on each staged file along with the data sync, and
+    publish also gets {staged path: digest}.
+    """
+
+    BATCH_FILES = 256
+    BATCH_BYTES = 0x10000000
+    BATCH_DELAY = 5.0
+
+    def __init__(self, publish, durability: str = "batch", digest=None):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Unknown durability level {durability!r}, must be one of {DURABILITY_LEVELS}")
+
+        self.publish = publish
+        self.durability = durability
+        self.digest = digest
+        self.pending: List[Tuple[str, str]] = []
+        self.pending_bytes = 0
+        self.oldest = 0.0
+
+    def add(self, src: str, dest: str, flush: bool = True):
+        """Stage a finished file. Unless flush is False, durability levels other than batch
+        publish it right away; otherwise, the caller has to."""
+        if not self.pending:
+            self.oldest = time.monotonic()
+        self.pending.append((src, dest))
+        self.pending_bytes += os.path.getsize(src)
+
+        if flush and self.durability != "batch":
+            self.flush()
+
+    @property
+    def blocking(self) -> bool:
+        """Whether prepare does anything that takes a while."""
+        return self.durability != "none" or self.digest is not None
+
+    def due(self) -> bool:
+        return bool(self.pending) and (
+            len(self.pending) >= self.BATCH_FILES
+            or self.pending_bytes >= self.BATCH_BYTES
+            or time.monotonic() - self.oldest >= self.BATCH_DELAY
+        )
+
+    def take(self) -> List[Tuple[str, str]]:
+        batch = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        return batch
+
+    def sync_data(self, batch: List[Tuple[str, str]]):
+        """Get the staged files' contents onto the disk. Doesn't touch the index, so it can
+        run on another thread."""
+        if self.durability == "none" or not batch:
+            return
+
+        if SYNCFS and len(batch) > 1:
+            fd = os.open(os.path.dirname(batch[0][0]), os.O_RDONLY)
+            try:
+                if SYNCFS(fd) != 0:
+                    raise OSError(ctypes.get_errno(), "syncfs failed")
+            finally:
+                os.close(fd)
+            return
+
+        for src, _ in batch:
+            fd = os.open(src, os.O_RDWR | getattr(os, "O_BINARY", 0))
+            try:
+                fdatasync(fd)
+            finally:
+                os.close(fd)
+
+    def prepare(self, batch: List[Tuple[str, str]]) -> Optional[Dict[str, str]]:
+        """Everything before the renaming: syncing the data, then computing the digests.
+        Like sync_data, this can run on another thread."""
+        self.sync_data(batch)
+        if self.digest is None:
+            return None
+        return {src: self.digest(src) for src, _ in batch}
+
+    def publish_batch(self, batch: List[Tuple[str, str]], digests: Optional[Dict[str, str]] = None):
+        if not batch:
+            return
+
+        if self.digest is None:
+            self.publish(batch)
+        else:
+            self.publish(batch, digests)
+        if self.durability != "none":
+            for pkg_dir in set(os.path.dirname(dest) for _, dest in batch):
+                fsync_directory(pkg_dir)
+
+    async def aio_flush(self):
+        """flush for the event loop thread. Syncing and hashing happen on another thread,
+        publishing on this one since the index can only be used from here."""
+        batch = self.take()
+        if batch and self.blocking:
+            digests = await asyncio.get_running_loop().run_in_executor(None, self.prepare, batch)
+        else:
+            digests = None
+        self.publish_batch(batch, digests)
+
+    def flush(self):
+        batch = self.take()
+        self.publish_batch(batch, self.prepare(batch))
+
+
 class PackageManager(object):
-    def __init__(self, master: str, search_paths: Iterable[str]):
+    def __init__(
+        self,
+        master: str,
+        search_paths: Iterable[str],
+        use_index: bool = True,
+        use_store: bool = True,
+        locations: Optional[Dict[str, int]] = None,
+    ):
+        """locations can be passed in from another PackageManager for the same search paths.
+        The caches aren't listed then, and partial downloads are left alone, as the
+        PackageManager they come from is in charge of them."""
         self.search_paths = list(search_paths)
-        self.package_state = self.compute_package_state(self.search_paths)
+        if use_index and not os.environ.get("ASTOOL_NO_PACKAGE_INDEX"):
+            self.indexes = {os.path.normpath(root): PackageIndex(root) for root in self.search_paths}
+        else:
+            self.indexes = {}
+        store_root = os.environ.get("ASTOOL_PACKAGE_STORE")
+        self.store = PackageStore(store_root) if use_store and store_root else None
+        # Which search path each package is in, as an index into search_paths.
+        if locations is None:
+            self.locations = self.compute_package_locations(self.search_paths, self.indexes)
+        else:
+            self.locations = dict(locations)
+        self.package_state = set(self.locations)
+        self.master = master
         self.asset_db = sqlite3.connect(master)
+        # execute_job_list replaces this with one using the durability it was asked for.
+        self.commit_stage = self._make_commit_stage("none")
+        self.progress = DownloadProgress()
+        if locations is None:
+            self.sweep_stale_partials()
 
     @staticmethod
-    def compute_package_state(roots: Iterable[str]):
-        package_prefixes = "0123456789abcdefghijklmnopqrstuvwxyz"
-        packages: Set[str] = set()
-        for root in roots:
-            for letter in package_prefixes:
-                os.makedirs(os.path.join(root, f"pkg{letter}"), exist_ok=True)
-                packages.update(x for x in os.listdir(os.path.join(root, f"pkg{letter}")) if x.startswith(letter))
-        return packages
+    def compute_package_locations(
+        roots: Iterable[str], indexes: Optional[Dict[str, PackageIndex]] = None
+    ) -> Dict[str, int]:
+        """Map the name of every package in roots to the position of the first root it's in."""
+        locations: Dict[str, int] = {}
+        for number, root in enumerate(roots):
+            packages: Set[str] = set()
+            if indexes and os.path.normpath(root) in indexes:
+                try:
+                    packages = indexes[os.path.normpath(root)].load()
+                except sqlite3.OperationalError as e:
+                    LOGGER.warning("Can't use the package index for %s (%s), listing it instead.", root, e)
+
+            if not packages:
+                for letter in PACKAGE_PREFIXES:
+                    os.makedirs(os.path.join(root, f"pkg{letter}"), exist_ok=True)
+                    packages.update(x for x in os.listdir(os.path.join(root, f"pkg{letter}")) if x.startswith(letter))
+
+            for name in packages:
+                locations.setdefault(name, number)
+        return locations
+
+    @classmethod
+    def compute_package_state(cls, roots: Iterable[str], indexes: Optional[Dict[str, PackageIndex]] = None):
+        return set(cls.compute_package_locations(roots, indexes))
+
+    def flush_indexes(self):
+        for index in self.indexes.values():
+            index.commit()
+        if self.store:
+            self.store.commit()
 
     def lookup_file(self, pack: str) -> Optional[str]:
-        for p in self.search_paths:
-            candidate = os.path.join(p, f"pkg{pack[0]}", pack)
-            if os.path.exists(candidate):
-                return candidate
-        return None
+        # Answered from what was listed at startup plus the changes made since, so files
+        # added or deleted behind our back by something else won't be noticed.
+        number = self.locations.get(pack)
+        if number is not None:
+            return os.path.join(self.search_paths[number], f"pkg{pack[0]}", pack)
+        return self.link_from_store(pack)
+
+    def _record_location(self, path: str):
+        # path is a file inside a pkgX directory of one of the search paths.
+        root = os.path.normpath(os.path.dirname(os.path.dirname(path)))
+        for number, candidate in enumerate(self.search_paths):
+            if os.path.normpath(candidate) == root:
+                name = os.path.basename(path)
+                if self.locations.get(name, number) >= number:
+                    self.locations[name] = number
+                return
+
+    def link_from_store(self, pack: str, size: Optional[int] = None) -> Optional[str]:
+        """Link a package the package store has into the cache. Returns its path if it worked.
+
+        Without a size, the one from the asset DB is used."""
+        if not self.store:
+            return None
+
+        if size is None:
+            row = self.asset_db.execute(
+                "SELECT file_size FROM m_asset_package_mapping WHERE pack_name = ? LIMIT 1", (pack,)
+            ).fetchone()
+            if not row:
+                return None
+            size = row[0]
+
+        dest = self.destination_for_new_file(pack)
+        with self._changing_directory(dest) as index:
+            if not self.store.link_out(pack, size, dest):
+                return None
+            if index:
+                index.record_added(pack)
+
+        self._record_location(dest)
+        self.package_state.add(pack)
+        return dest
 
     def lookup_all_package_groups(self) -> Iterable[str]:
         for (pkey,) in self.asset_db.execute("SELECT package_key FROM m_asset_package"):
@@ -96,63 +789,239 @@ class PackageManager(object):
 
         return partial, missing
 
+    def validate_package_groups(
+        self, patterns: Optional[Iterable[str]] = None
+    ) -> Tuple[List[Tuple[str, int, int]], Set[str]]:
+        """Check every package group matching patterns (all of them if None) at once.
+
+        Returns (package_key, packages present, packages in the group) for each group, and
+        the names of all the missing packages. Instead of a query per group like
+        get_package_group, the packages on disk go into a temp table and the counts come
+        from one grouped join.
+        """
+        where = " OR ".join("package_key LIKE ?" for _ in patterns) if patterns else "1"
+        args = tuple(patterns or ())
+        groups = f"SELECT package_key FROM m_asset_package WHERE {where}"
+        with self.temp_name_table("present_packs", self.package_state) as present:
+            counts = self.asset_db.execute(
+                f"""SELECT m.package_key, COUNT(DISTINCT p.name), COUNT(DISTINCT m.pack_name)
+                FROM m_asset_package_mapping m LEFT JOIN {present} p ON p.name = m.pack_name
+                WHERE m.package_key IN ({groups})
+                GROUP BY m.package_key ORDER BY m.package_key""",
+                args,
+            ).fetchall()
+            missing = set(
+                name
+                for name, in self.asset_db.execute(
+                    f"""SELECT DISTINCT pack_name FROM m_asset_package_mapping
+                    WHERE package_key IN ({groups}) AND pack_name NOT IN (SELECT name FROM {present})""",
+                    args,
+                )
+            )
+
+        return counts, missing
+
+    def changed_packages(self, old_master: str, patterns: Optional[Iterable[str]] = None) -> Set[str]:
+        """Missing packages of the groups matching patterns (every group if None) that the asset
+        DB at old_master didn't list in the same way.
+
+        This is what a group needs if everything it needed under old_master is still there,
+        found by comparing the two asset DBs in SQLite instead of checking every package.
+        """
+        where = " OR ".join("package_key LIKE ?" for _ in patterns) if patterns else "1"
+        columns = "package_key, pack_name, file_size, metapack_name, metapack_offset"
+        # ATTACH can't happen inside a transaction, and temp_name_table may have left one open.
+        self.asset_db.commit()
+        self.asset_db.execute("ATTACH DATABASE ? AS old_master", (old_master,))
+        try:
+            changed = set(
+                name
+                for name, in self.asset_db.execute(
+                    f"""SELECT DISTINCT pack_name FROM (
+                        SELECT {columns} FROM main.m_asset_package_mapping WHERE {where}
+                        EXCEPT SELECT {columns} FROM old_master.m_asset_package_mapping
+                    )""",
+                    tuple(patterns or ()),
+                )
+            )
+        finally:
+            self.asset_db.execute("DETACH DATABASE old_master")
+
+        return changed - self.package_state
+
     def get_unreferenced_packages(self) -> set:
         indexed = set(package for package, in self.asset_db.execute("SELECT pack_name FROM m_asset_package_mapping"))
         return self.package_state - indexed
 
-    def resolve_metapackages(self, metas: Set[str]) -> Tuple[set, list]:
+    @contextmanager
+    def temp_name_table(self, table: str, names: Iterable[str]):
+        """Load names into a temporary table (one column, "name") on the asset DB for joining against."""
+        self.asset_db.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (name TEXT PRIMARY KEY)")
+        self.asset_db.execute(f"DELETE FROM temp.{table}")
+        self.asset_db.executemany(f"INSERT OR IGNORE INTO temp.{table} VALUES (?)", ((x,) for x in names))
+        try:
+            yield f"temp.{table}"
+        finally:
+            self.asset_db.execute(f"DROP TABLE temp.{table}")
+
+    @staticmethod
+    def group_metapackage_splits(rows: Iterable[Tuple[str, int, str, int]]) -> Tuple[set, list]:
+        """Turn (pack_name, file_size, metapack_name, metapack_offset) rows ordered by
+        metapack_name, metapack_offset into MetapackageDownloadTasks."""
         seen_list = set()
         tasks = []
-
-        query = """SELECT DISTINCT pack_name, file_size, metapack_name, metapack_offset
-            FROM m_asset_package_mapping WHERE metapack_name IN ({0})
-            ORDER BY metapack_name, metapack_offset"""
-
-        split_list = None
-        mp_name = None
-        for pack_name, file_size, metapack_name, metapack_offset in fast_select(self.asset_db, query, metas):
-            if mp_name != metapack_name:
-                if mp_name:
-                    split_list.sort(key=lambda x: x.offset)
-                    tasks.append(MetapackageDownloadTask(mp_name, split_list, True))
-                mp_name = metapack_name
-                split_list = []
-
-            seen_list.add(pack_name)
-            split_list.append(PackageDownloadTask(pack_name, file_size, metapack_offset, False))
-
-        if split_list:
-            split_list.sort(key=lambda x: x.offset)
+        for mp_name, mp_rows in itertools.groupby(rows, key=lambda row: row[2]):
+            split_list = []
+            for pack_name, file_size, _, metapack_offset in mp_rows:
+                seen_list.add(pack_name)
+                split_list.append(PackageDownloadTask(pack_name, file_size, metapack_offset, False))
             tasks.append(MetapackageDownloadTask(mp_name, split_list, True))
 
         return seen_list, tasks
 
+    def resolve_metapackages(self, metas: Set[str]) -> Tuple[set, list]:
+        with self.temp_name_table("wanted_metapacks", metas) as wanted:
+            rows = self.asset_db.execute(
+                f"""SELECT DISTINCT pack_name, file_size, metapack_name, metapack_offset
+                FROM m_asset_package_mapping WHERE metapack_name IN (SELECT name FROM {wanted})
+                ORDER BY metapack_name, metapack_offset"""
+            ).fetchall()
+
+        return self.group_metapackage_splits(rows)
+
     def compute_download_list(self, wanted_pkgs: Set[str]) -> List[AnyDownloadTask]:
         dl: List[AnyDownloadTask] = []
-        llen = None
-        sqls = ""
-        cur = self.asset_db.cursor()
-        while wanted_pkgs:
-            metapackages = set()
-            page = [wanted_pkgs.pop() for _ in range(min(len(wanted_pkgs), 500))]
-            if llen != len(page):
-                llen = len(page)
-                qs = ",".join("?" for _ in range(llen))
-                sqls = "SELECT DISTINCT pack_name, metapack_name, file_size FROM m_asset_package_mapping WHERE pack_name IN ({0})".format(
-                    qs
+        with self.temp_name_table("wanted_packs", wanted_pkgs) as wanted:
+            for pack_name, file_size in self.asset_db.execute(
+                f"""SELECT DISTINCT pack_name, file_size FROM m_asset_package_mapping
+                WHERE pack_name IN (SELECT name FROM {wanted})
+                    AND (metapack_name IS NULL OR metapack_name = '')"""
+            ):
+                dl.append(PackageDownloadTask(pack_name, file_size, 0, False))
+
+            # Every split of a metapackage holding a wanted pack, in download order.
+            rows = self.asset_db.execute(
+                f"""SELECT DISTINCT pack_name, file_size, metapack_name, metapack_offset
+                FROM m_asset_package_mapping WHERE metapack_name IN (
+                    SELECT metapack_name FROM m_asset_package_mapping
+                    WHERE pack_name IN (SELECT name FROM {wanted}) AND metapack_name != ''
                 )
+                ORDER BY metapack_name, metapack_offset"""
+            ).fetchall()
 
-            for pack_name, metapack_name, file_size in cur.execute(sqls, page):
-                if not metapack_name:
-                    dl.append(PackageDownloadTask(pack_name, file_size, 0, False))
-                else:
-                    metapackages.add(metapack_name)
+        _, dl_tasks = self.group_metapackage_splits(rows)
+        dl.extend(dl_tasks)
+        if self.store:
+            dl = self.take_from_store(dl)
+        return dl
 
-            seen_packages, dl_tasks = self.resolve_metapackages(metapackages)
-            dl.extend(dl_tasks)
-            wanted_pkgs -= seen_packages
+    def take_from_store(self, dl: List[AnyDownloadTask]) -> List[AnyDownloadTask]:
+        """Link whatever the package store has into the cache, and drop the tasks that
+        leaves nothing to download for."""
+        remaining: List[AnyDownloadTask] = []
+        linked = 0
+        for task in dl:
+            splits = task.splits if task.is_meta else [task]
+            for split in splits:
+                if split.name not in self.package_state and self.link_from_store(split.name, split.size):
+                    linked += 1
 
-        return dl
+            if any(split.name not in self.package_state for split in splits):
+                remaining.append(task)
+
+        self.store.commit()
+        if linked:
+            LOGGER.info("Linked %d packages from the package store.", linked)
+        return remaining
+
+    def dedupe_packages(self, threads: int = VERIFY_THREADS) -> Tuple[int, int]:
+        """Move every package in the cache into the package store, replacing copies of files
+        it already has with links. Returns the number of packages moved and the bytes saved.
+        """
+        files = self.scan_package_files(threads)
+        todo = []
+        for name, (root, _, _) in files.items():
+            path = os.path.join(root, f"pkg{name[0]}", name)
+            if not self.store.is_linked(name, path):
+                todo.append((name, path))
+
+        saved = 0
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            hashes = executor.map(lambda item: hash_file(item[1]), todo)
+            for (name, path), sha in zip(todo, hashes):
+                with self._changing_directory(path) as index:
+                    saved += self.store.adopt(name, path, sha)
+                    if index:
+                        index.record_added(name)
+
+        self.flush_indexes()
+        return len(todo), saved
+
+    def scan_package_files(self, threads: int = VERIFY_THREADS) -> Dict[str, Tuple[str, int, int]]:
+        """Stat every package in the search paths. Returns {name: (root, size, mtime_ns)}.
+
+        Directories are listed in parallel. If a package is in more than one root, the
+        first one wins, like in lookup_file.
+        """
+
+        def scan(root: str, letter: str):
+            rows = []
+            with os.scandir(os.path.join(root, f"pkg{letter}")) as it:
+                for entry in it:
+                    if entry.name.startswith(letter) and entry.is_file():
+                        st = entry.stat()
+                        rows.append((entry.name, root, st.st_size, st.st_mtime_ns))
+            return rows
+
+        files: Dict[str, Tuple[str, int, int]] = {}
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            dirs = [(root, letter) for root in self.search_paths for letter in PACKAGE_PREFIXES]
+            for rows in executor.map(lambda args: scan(*args), dirs):
+                for name, root, size, mtime_ns in rows:
+                    files.setdefault(name, (root, size, mtime_ns))
+        return files
+
+    def verify_packages(self, threads: int = VERIFY_THREADS) -> Tuple[int, Set[str]]:
+        """Compare the size of every package on disk against the asset DB.
+
+        Returns the number of packages checked and the names of those with the wrong size,
+        which are also taken out of package_state so they count as missing. Packages that
+        passed before and whose size and mtime haven't changed since are skipped. Packages
+        the asset DB doesn't know about are left alone.
+        """
+        files = self.scan_package_files(threads)
+        cached = {root: index.verified_stats() for root, index in self.indexes.items()}
+        unchecked = {
+            name: stat
+            for name, stat in files.items()
+            if cached.get(os.path.normpath(stat[0]), {}).get(name) != stat[1:]
+        }
+
+        with self.temp_name_table("verify_packs", unchecked) as table:
+            expected = dict(
+                self.asset_db.execute(
+                    f"""SELECT pack_name, file_size FROM m_asset_package_mapping
+                    WHERE pack_name IN (SELECT name FROM {table})"""
+                )
+            )
+
+        bad: Set[str] = set()
+        good: Dict[str, list] = {}
+        for name, (root, size, mtime_ns) in unchecked.items():
+            want = expected.get(name)
+            if want is None:
+                continue
+            if size != want:
+                bad.add(name)
+            else:
+                good.setdefault(os.path.normpath(root), []).append((name, size, mtime_ns))
+
+        for root, index in self.indexes.items():
+            index.record_verified(good.get(root, ()), bad)
+
+        LOGGER.debug("verify_packages: %d of %d packages needed checking.", len(unchecked), len(files))
+        self.package_state -= bad
+        return len(files), bad
 
     def prune_package_list(self, pkgs: Iterable[str]) -> Set[str]:
         query = """SELECT pack_name FROM m_asset_pack WHERE pack_name IN ({0})"""
@@ -172,22 +1041,45 @@ class PackageManager(object):
 
         return deduplicated_dls
 
-    def execute_job_list(self, ice, jobs, done=None):
-        url_list = ice.api.asset.getPackUrl({"pack_names": [job.name for job in jobs]})
-        ua = ice.user_agent
-        if done:
-            done(ice)
+    def execute_job_list(
+        self,
+        ice,
+        jobs,
+        done=None,
+        workers=None,
+        rate_limit=None,
+        reacquire=None,
+        durability="batch",
+        processes=1,
+        progress=None,
+    ):
+        """Download the given tasks.
 
-        if url_list.return_code != 0:
-            raise ValueError("Failed to get the url list!")
-
-        url_list = url_list.app_data["url_list"]
-        assert len(url_list) == len(jobs)
-
-        if aiohttp and not os.environ.get("ASTOOL_NEVER_AIO"):
-            asyncio.run(self.download_with_aiohttp(zip(jobs, url_list), len(jobs), ua))
-        else:
-            self.download_with_requests(zip(jobs, url_list), len(jobs), ua)
+        URLs are signed in batches while the download runs; ice is passed to done when
+        the last batch has been signed. reacquire is used to re-sign URLs that expire
+        after that, see PackURLSigner. workers fixes the number of concurrent downloads;
+        by default it adapts to the observed throughput. rate_limit caps the total
+        download rate in bytes per second. durability is passed to CommitStage. With
+        processes > 1, the download is split across that many worker processes. progress
+        is a DownloadProgress to report to; by default one that only logs is used.
+        """
+        self.commit_stage = self._make_commit_stage(durability)
+        self.progress = progress or DownloadProgress()
+        self.progress.add_jobs(self._remaining_size(job) for job in jobs)
+        signer = PackURLSigner(ice, jobs, done, reacquire)
+        try:
+            if aiohttp and not os.environ.get("ASTOOL_NEVER_AIO") and processes > 1:
+                self.download_sharded(signer, len(jobs), processes, workers, rate_limit)
+            elif aiohttp and not os.environ.get("ASTOOL_NEVER_AIO"):
+                asyncio.run(self.download_with_aiohttp(signer, len(jobs), workers, rate_limit))
+            else:
+                self.download_with_requests(signer, len(jobs), rate_limit)
+        finally:
+            # Whatever finished before a failure still gets published.
+            self.commit_stage.flush()
+            self.progress.report(force=True)
+            signer.close()
+            self.flush_indexes()
 
     def meta_list_is_monotonic(self, split_list: Iterable[PackageDownloadTask]):
         offset = 0
@@ -201,119 +1093,680 @@ class PackageManager(object):
     def destination_for_new_file(self, package_name: str):
         return os.path.join(self.search_paths[-1], f"pkg{package_name[0]}", package_name)
 
-    def _allocate_file(self, dest_pkg_name):
-        final_dest = self.destination_for_new_file(dest_pkg_name)
-        tmp_target = tempfile.NamedTemporaryFile("wb", prefix=".pkg_temp", dir=os.path.dirname(final_dest), delete=False)
-        return final_dest, tmp_target
+    @contextmanager
+    def _changing_directory(self, path: str):
+        # path is a file inside a pkgX directory of one of the search paths.
+        pkg_dir = os.path.dirname(path)
+        index = self.indexes.get(os.path.dirname(pkg_dir))
+        if index:
+            with index.changing(os.path.basename(pkg_dir)):
+                yield index
+        else:
+            yield None
 
-    @staticmethod
-    def _move_file_into_place(src, dest):
-        os.chmod(src, 0o644)
+    @property
+    def staging_dir(self) -> str:
+        return os.path.join(self.search_paths[-1], "partial")
+
+    def sweep_stale_partials(self):
+        """Delete partial downloads that can't or won't be resumed."""
+        if not os.path.isdir(self.staging_dir):
+            # First run with a staging directory. Earlier versions left their
+            # temp files inside the pkgX directories, so clear those out once.
+            for letter in PACKAGE_PREFIXES:
+                pkg_dir = os.path.join(self.search_paths[-1], f"pkg{letter}")
+                for name in os.listdir(pkg_dir):
+                    if name.startswith(".pkg_temp"):
+                        os.unlink(os.path.join(pkg_dir, name))
+            os.makedirs(self.staging_dir, exist_ok=True)
+            return
+
+        now = time.time()
+        names = set(os.listdir(self.staging_dir))
+        for name in names:
+            path = os.path.join(self.staging_dir, name)
+            try:
+                age = now - os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+
+            # Files without their other half can't be resumed, but give them a while
+            # in case another process is still writing them.
+            if name.endswith(".json"):
+                orphaned = name[:-5] not in names
+            else:
+                orphaned = (name + ".json") not in names
+
+            if age > PARTIAL_MAX_AGE or (orphaned and age > PARTIAL_ORPHAN_AGE):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def _staged_length(self, name: str, size: int) -> int:
+        """How many bytes of the package are already in the staging directory."""
+        if size < RESUME_MIN_SIZE:
+            return 0
+
+        staged = os.path.join(self.staging_dir, name)
         try:
-            os.unlink(dest)
-        except FileNotFoundError:
-            pass
-        os.rename(src, dest)
-
-    async def aio_download_task(self, session, queue):
-        while not queue.empty():
-            task, url = await queue.get()
-            canon = task.name
-            logging.info("Begin retrieving %s, %d left...", canon, queue.qsize())
-            resp = await session.get(url)
-            # logging.info("Checkpoint %s: response received...", canon)
-
-            if task.is_meta:
-                assert self.meta_list_is_monotonic(task.splits)
-                offset = 0
-
-                for split in task.splits:
-                    # logging.info("Checkpoint %s: beginning demux for %s...", canon, split.name)
-                    if offset < split.offset:
-                        rem = split.offset - offset
-                        while rem:
-                            chunk = await resp.content.read(min(0x10000, rem))
-                            if not chunk:
-                                break
-                            rem -= len(chunk)
-                            offset += len(chunk)
-
-                    assert offset == split.offset, f"{canon}: {split.name} not aligned at start"
-
-                    final_dest, tmp_target = self._allocate_file(split.name)
-                    rem = split.size
-                    with tmp_target:
-                        while True:
-                            chunk = await resp.content.read(min(0x10000, rem))
-                            if not chunk:
-                                break
-                            tmp_target.write(chunk)
-                            offset += len(chunk)
-                            rem -= len(chunk)
-
-                    assert rem == 0, f"{canon}: {split.name} not fully written"
-
-                    self._move_file_into_place(tmp_target.name, final_dest)
-                    self.package_state.add(split.name)
+            with open(staged + ".json", "r") as jf:
+                journal = json.load(jf)
+            have = os.path.getsize(staged)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+        if journal.get("size") != size or have > size:
+            return 0
+        # Always leave at least one byte to fetch. A request starting at the very
+        # end of the URL would be rejected.
+        return min(have, size - 1)
+
+    def _missing_ranges(self, task: MetapackageDownloadTask) -> List[list]:
+        """The parts of a metapackage that still have to be fetched, as [start, end, splits].
+
+        Splits that are already in the cache are left out, and partially staged ones
+        start where the staged data ends. Ranges whose gap is at most COALESCE_GAP are
+        merged, the bytes in between are read and thrown away.
+        """
+        ranges: List[list] = []
+        for split in task.splits:
+            if split.name in self.package_state:
+                continue
+
+            start = split.offset + self._staged_length(split.name, split.size)
+            end = split.offset + split.size
+            if ranges and start - ranges[-1][1] <= COALESCE_GAP:
+                ranges[-1][1] = end
+                ranges[-1][2].append(split)
             else:
-                final_dest, tmp_target = self._allocate_file(canon)
-                # logging.info("Checkpoint %s: beginning demux for %s...", canon, canon)
-                with tmp_target:
-                    while True:
-                        chunk = await resp.content.read(0x10000)
-                        if not chunk:
-                            break
-                        tmp_target.write(chunk)
+                ranges.append([start, end, [split]])
+
+        return ranges
+
+    def _remaining_size(self, task: AnyDownloadTask) -> int:
+        """How many bytes fetching task will take, given what is already staged or cached."""
+        if task.is_meta:
+            return sum(end - start for start, end, _ in self._missing_ranges(task))
+        return task.size - self._staged_length(task.name, task.size)
+
+    def _allocate_file(self, dest_pkg_name, size=0, source=None, source_offset=0):
+        """Open the staging file for a package.
+
+        Returns (final_dest, file, have). If an earlier attempt left a usable partial
+        download, the file is opened for appending and have is its length. Packages
+        of at least RESUME_MIN_SIZE get a journal recording where they come from.
+        """
+        final_dest = self.destination_for_new_file(dest_pkg_name)
+        staged = os.path.join(self.staging_dir, dest_pkg_name)
+
+        have = self._staged_length(dest_pkg_name, size)
+        if have:
+            tmp_target = open(staged, "ab", buffering=WRITE_BUFFER)
+            tmp_target.truncate(have)
+        else:
+            if size >= RESUME_MIN_SIZE:
+                with open(staged + ".json", "w") as jf:
+                    json.dump({"size": size, "source": source or dest_pkg_name, "offset": source_offset}, jf)
+            tmp_target = open(staged, "wb", buffering=WRITE_BUFFER)
+
+        preallocate(tmp_target.fileno(), have, size - have)
+        return final_dest, tmp_target, have
 
-                self._move_file_into_place(tmp_target.name, final_dest)
-                self.package_state.add(canon)
+    def _finish_file(self, tmp_target, final_dest: str, name: str):
+        # The file may sit in the commit stage for a bit, but as far as this run is
+        # concerned it's done.
+        self.commit_stage.add(tmp_target.name, final_dest)
+        self.package_state.add(name)
 
-            queue.task_done()
-            # logging.info("Done retrieving %s, %d left...", canon, queue.qsize())
+    async def _aio_finish_file(self, tmp_target, final_dest: str, name: str):
+        self.commit_stage.add(tmp_target.name, final_dest, flush=False)
+        self.package_state.add(name)
+        if self.commit_stage.durability != "batch":
+            await self.commit_stage.aio_flush()
 
-    async def download_with_aiohttp(self, jobs, count, user_agent):
-        with execution_timer("Prepare queue"):
-            queue = asyncio.Queue()
-            for job in jobs:
-                queue.put_nowait(job)
+    def _make_commit_stage(self, durability: str) -> CommitStage:
+        # Packages going into the store need hashing, which is better done off the event loop.
+        return CommitStage(self._move_files_into_place, durability, hash_file if self.store else None)
+
+    def _move_files_into_place(self, batch: List[Tuple[str, str]], digests: Optional[Dict[str, str]] = None):
+        by_dir: Dict[str, List[Tuple[str, str]]] = {}
+        for src, dest in batch:
+            by_dir.setdefault(os.path.dirname(dest), []).append((src, dest))
+
+        for files in by_dir.values():
+            with self._changing_directory(files[0][1]) as index:
+                for src, dest in files:
+                    os.chmod(src, 0o644)
+                    try:
+                        os.unlink(dest)
+                    except FileNotFoundError:
+                        pass
+                    os.rename(src, dest)
+                    if self.store:
+                        self.store.adopt(os.path.basename(dest), dest, digests and digests.get(src))
+                    self._record_location(dest)
+
+                    if index:
+                        index.record_added(os.path.basename(dest))
+
+            for src, _ in files:
+                try:
+                    os.unlink(src + ".json")
+                except FileNotFoundError:
+                    pass
+
+        if self.store:
+            # Other processes may be waiting to use the store.
+            self.store.commit()
+
+    def remove_package(self, pack: str) -> bool:
+        fqpkg = self.lookup_file(pack)
+        if not fqpkg:
+            return False
+
+        with self._changing_directory(fqpkg) as index:
+            os.unlink(fqpkg)
+            if index:
+                index.record_removed(pack)
+
+        self.locations.pop(pack, None)
+        self.package_state.discard(pack)
+        return True
+
+    def move_package(self, pack: str, number: int) -> bool:
+        """Move a package to search_paths[number]. Returns False if it was already there."""
+        src = self.lookup_file(pack)
+        if not src or self.locations.get(pack) == number:
+            return False
+
+        dest_dir = os.path.join(self.search_paths[number], f"pkg{pack[0]}")
+        dest = os.path.join(dest_dir, pack)
+        # Both directories change, so both indexes have to know before either does.
+        with self._changing_directory(dest) as dest_index, self._changing_directory(src) as src_index:
+            try:
+                os.rename(src, dest)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # Different disks. Copy under a name that isn't listed as a package first.
+                tmp = os.path.join(dest_dir, f".pkg_temp_{pack}")
+                shutil.copy2(src, tmp)
+                os.rename(tmp, dest)
+                os.unlink(src)
+            if dest_index:
+                dest_index.record_added(pack)
+            if src_index:
+                src_index.record_removed(pack)
+
+        self.locations[pack] = number
+        return True
+
+    def promote_packages(self, packs: Iterable[str], number: int = 0) -> Tuple[int, int]:
+        """Move packages to search_paths[number], the first (and fastest) one by default.
+        Returns the number of packages and bytes moved."""
+        count = nbytes = 0
+        for pack in packs:
+            if self.locations.get(pack) is None or self.locations[pack] == number:
+                continue
+
+            size = os.path.getsize(self.lookup_file(pack))
+            if self.move_package(pack, number):
+                count += 1
+                nbytes += size
+
+        self.flush_indexes()
+        return count, nbytes
+
+    async def aio_download_task(self, session, scheduler, signer):
+        scheduler.active += 1
+        try:
+            while True:
+                # Workers leave here when the scheduler wants fewer of them.
+                next_job = scheduler.next_job()
+                if next_job is None:
+                    break
+
+                task, url, attempt = next_job
+                logging.info("Begin retrieving %s, %d left...", task.name, len(scheduler))
+                self.progress.start(task.name, self._remaining_size(task))
+                try:
+                    await self.aio_fetch(session, task, url, scheduler)
+                    self.progress.finish(task.name)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self.progress.finish(task.name, completed=False)
+                    status = getattr(e, "status", None)
+                    if attempt + 1 >= DOWNLOAD_ATTEMPTS:
+                        raise
+                    if status == 403:
+                        LOGGER.info("URL for %s expired, signing it again.", task.name)
+                        url = await asyncio.wrap_future(signer.resign(task.name))
+                        scheduler.retry(task, url, attempt, backoff=False)
+                        continue
+                    if status and status < 500 and status != 429:
+                        raise
+                    LOGGER.warning("Retrieving %s failed (%s), will retry.", task.name, e)
+                    scheduler.retry(task, url, attempt)
+        finally:
+            scheduler.active -= 1
+
+    async def aio_read(self, resp, n: int, scheduler, name: str) -> bytes:
+        chunk = await resp.content.read(n)
+        self.progress.advance(name, len(chunk))
+        wait = scheduler.record(len(chunk))
+        if wait:
+            await asyncio.sleep(wait)
+        return chunk
+
+    async def aio_demux(self, resp, offset: int, splits, canon: str, scheduler):
+        """Write splits out of a response body that starts at offset in the metapackage."""
+        for split in splits:
+            # logging.info("Checkpoint %s: beginning demux for %s...", canon, split.name)
+            final_dest, tmp_target, have = self._allocate_file(split.name, split.size, canon, split.offset)
+            while offset < split.offset + have:
+                chunk = await self.aio_read(resp, min(READ_CHUNK, split.offset + have - offset), scheduler, canon)
+                if not chunk:
+                    break
+                offset += len(chunk)
+            if offset != split.offset + have:
+                raise aiohttp.ClientPayloadError(f"{canon}: body ended before {split.name}")
+
+            rem = split.size - have
+            with tmp_target:
+                while rem:
+                    chunk = await self.aio_read(resp, min(READ_CHUNK, rem), scheduler, canon)
+                    if not chunk:
+                        break
+                    tmp_target.write(chunk)
+                    offset += len(chunk)
+                    rem -= len(chunk)
+
+            if rem:
+                # Keep what we have, the next attempt resumes from there.
+                raise aiohttp.ClientPayloadError(f"{canon}: body ended {rem} bytes into {split.name}")
+
+            await self._aio_finish_file(tmp_target, final_dest, split.name)
+
+    async def aio_fetch(self, session, task, url, scheduler):
+        canon = task.name
+        if task.is_meta:
+            assert self.meta_list_is_monotonic(task.splits)
+
+            ranges = self._missing_ranges(task)
+            while ranges:
+                start, end, splits = ranges[0]
+                if start == end:
+                    # Only empty packages, there's nothing to request.
+                    await self.aio_demux(None, start, splits, canon, scheduler)
+                    ranges.pop(0)
+                    continue
+
+                async with session.get(url, headers={"Range": f"bytes={start}-{end - 1}"}) as resp:
+                    resp.raise_for_status()
+                    # logging.info("Checkpoint %s: response received...", canon)
+                    if resp.status == 206:
+                        offset = start
+                        ranges.pop(0)
+                    else:
+                        # The server ignored the range and sent the whole thing, so take
+                        # every remaining split from this response.
+                        offset = 0
+                        splits = [split for r in ranges for split in r[2]]
+                        ranges = []
+
+                    await self.aio_demux(resp, offset, splits, canon, scheduler)
+            return
+
+        have = self._staged_length(canon, task.size)
+        headers = {"Range": f"bytes={have}-"} if have else {}
+        async with session.get(url, headers=headers) as resp:
+            resp.raise_for_status()
+            # If the server ignored the range, throw away the prefix we already have.
+            offset = have if resp.status == 206 else 0
+
+            final_dest, tmp_target, have = self._allocate_file(canon, task.size)
+            while offset < have:
+                chunk = await self.aio_read(resp, min(READ_CHUNK, have - offset), scheduler, canon)
+                if not chunk:
+                    break
+                offset += len(chunk)
+
+            # logging.info("Checkpoint %s: beginning demux for %s...", canon, canon)
+            with tmp_target:
+                while True:
+                    chunk = await self.aio_read(resp, READ_CHUNK, scheduler, canon)
+                    if not chunk:
+                        break
+                    tmp_target.write(chunk)
+                length = tmp_target.tell()
+
+            if length != task.size:
+                # The connection closed early without an error. Keep what we have, the next
+                # attempt resumes from there.
+                raise aiohttp.ClientPayloadError(f"{canon}: got {length} of {task.size} bytes")
+            await self._aio_finish_file(tmp_target, final_dest, canon)
+        # logging.info("Done retrieving %s...", canon)
+
+    async def download_with_aiohttp(self, signer, count, workers=None, rate_limit=None):
+        scheduler = DownloadScheduler(workers, rate_limit)
+        batches = iter(signer.batches)
+
+        def next_batch():
+            future = next(batches, None)
+            return future and asyncio.wrap_future(future)
 
         with execution_timer("Download tasks"):
-            async with aiohttp.ClientSession(headers={"User-Agent": user_agent}) as session:
-                tasks = []
-                for i in range(10):
-                    task = asyncio.create_task(self.aio_download_task(session, queue))
-                    tasks.append(task)
+            # Big metapackages can take a long time on a throttled link, so only time out stalls.
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+            connector = aiohttp.TCPConnector(limit=scheduler.max_workers)
+            async with aiohttp.ClientSession(
+                headers={"User-Agent": signer.user_agent}, timeout=timeout, connector=connector
+            ) as session:
+                signing = next_batch()
+                tasks = set()
+                try:
+                    while scheduler or tasks or signing is not None:
+                        while len(tasks) < scheduler.target and len(tasks) < len(scheduler):
+                            tasks.add(asyncio.create_task(self.aio_download_task(session, scheduler, signer)))
+
+                        waiting = tasks | {signing} if signing is not None else tasks
+                        done, _ = await asyncio.wait(
+                            waiting, timeout=scheduler.SAMPLE_INTERVAL, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        if signing in done:
+                            done.discard(signing)
+                            for job, url in signing.result():
+                                scheduler.add(job, url)
+                            signing = next_batch()
 
-                tasks.append(asyncio.create_task(queue.join()))
-                await asyncio.gather(*tasks)
+                        tasks -= done
+                        for task in done:
+                            task.result()
 
-    def download_with_requests(self, jobs, count, user_agent):
+                        scheduler.sample()
+                        self.progress.report()
+                        if self.commit_stage.due():
+                            await self.commit_stage.aio_flush()
+                finally:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+
+    def download_sharded(self, signer, count, processes, workers=None, rate_limit=None):
+        """Split the download across worker processes, each running download_with_aiohttp.
+
+        At high bandwidth a single event loop runs out of CPU. Jobs are handed out as
+        their batch gets signed, each to the process that has been given the fewest bytes
+        so far. Workers leave finished files in the staging directory and send them here
+        to go through this process's commit stage, so only the parent uses the index.
+        Workers and the rate limit are split evenly between the processes.
+        """
+        mp = multiprocessing.get_context("spawn")
+        results = mp.Queue()
+        shards = []
+        for shard in range(processes):
+            jobs_in = mp.Queue()
+            proc = mp.Process(
+                target=download_shard,
+                args=(
+                    self.master,
+                    self.search_paths,
+                    self.locations,
+                    shard,
+                    signer.user_agent,
+                    workers and max(1, workers // processes),
+                    rate_limit and max(1, rate_limit // processes),
+                    logging.getLogger().level,
+                    jobs_in,
+                    results,
+                ),
+                daemon=True,
+            )
+            proc.start()
+            shards.append((proc, jobs_in))
+
+        loads = [0] * processes
+        pending = list(signer.batches)
+        ended = False
+        exited: Set[int] = set()
+        published = published_bytes = 0
+        try:
+            while len(exited) < processes:
+                while pending and pending[0].done():
+                    assignment: List[list] = [[] for _ in shards]
+                    for job, url in pending.pop(0).result():
+                        shard = loads.index(min(loads))
+                        loads[shard] += download_task_size(job)
+                        assignment[shard].append((job, url))
+
+                    for (_, jobs_in), jobs in zip(shards, assignment):
+                        if jobs:
+                            jobs_in.put(("jobs", jobs))
+
+                # Also covers having no batches at all.
+                if not pending and not ended:
+                    for _, jobs_in in shards:
+                        jobs_in.put(("end",))
+                    ended = True
+
+                if self.commit_stage.due():
+                    self.commit_stage.flush()
+                self.progress.report()
+
+                try:
+                    kind, shard, payload = results.get(timeout=0.2)
+                except queue.Empty:
+                    for shard, (proc, _) in enumerate(shards):
+                        if shard not in exited and proc.exitcode:
+                            raise RuntimeError(f"Download worker {shard} died with exit code {proc.exitcode}.")
+                    continue
+
+                if kind == "files":
+                    for src, dest in payload:
+                        published += 1
+                        published_bytes += os.path.getsize(src)
+                        self.commit_stage.add(src, dest)
+                        self.package_state.add(os.path.basename(dest))
+                elif kind == "progress":
+                    self.progress.merge(shard, payload)
+                elif kind == "expired":
+                    shards[shard][1].put(("url", payload, signer.resign(payload).result()))
+                elif kind == "error":
+                    raise RuntimeError(f"Download worker {shard} failed:\n{payload}")
+                else:
+                    exited.add(shard)
+        finally:
+            for shard, (proc, _) in enumerate(shards):
+                if shard not in exited:
+                    proc.terminate()
+                proc.join()
+
+        LOGGER.info("%d packages (%d MB) downloaded.", published, published_bytes / 1048576)
+
+    def demux_chunks(self, chunks, offset: int, splits, canon: str, limiter: BandwidthLimiter):
+        """Write splits out of an iterator of body chunks that starts at offset in the metapackage.
+
+        Only the chunk being worked on is kept in memory.
+        """
+        buf = memoryview(b"")
+
+        def take(n: int) -> memoryview:
+            nonlocal buf
+            if not buf:
+                buf = memoryview(next(chunks, b""))
+                self.progress.advance(canon, len(buf))
+                wait = limiter.delay(len(buf))
+                if wait:
+                    time.sleep(wait)
+            piece, buf = buf[:n], buf[n:]
+            return piece
+
+        for split in splits:
+            LOGGER.debug("    %s...", split.name)
+            final_dest, tmp_target, have = self._allocate_file(split.name, split.size, canon, split.offset)
+            while offset < split.offset + have:
+                piece = take(split.offset + have - offset)
+                if not piece:
+                    break
+                offset += len(piece)
+            if offset != split.offset + have:
+                raise requests.exceptions.ChunkedEncodingError(f"{canon}: body ended before {split.name}")
+
+            rem = split.size - have
+            with tmp_target:
+                while rem:
+                    piece = take(rem)
+                    if not piece:
+                        break
+                    tmp_target.write(piece)
+                    offset += len(piece)
+                    rem -= len(piece)
+
+            if rem:
+                # Keep what we have, the next attempt resumes from there.
+                raise requests.exceptions.ChunkedEncodingError(f"{canon}: body ended {rem} bytes into {split.name}")
+
+            self._finish_file(tmp_target, final_dest, split.name)
+
+    def fetch_with_requests(self, dl_session, job, url, user_agent, limiter: BandwidthLimiter):
+        canon = job.name
+        if job.is_meta:
+            assert self.meta_list_is_monotonic(job.splits)
+
+            ranges = self._missing_ranges(job)
+            while ranges:
+                start, end, splits = ranges[0]
+                if start == end:
+                    # Only empty packages, there's nothing to request.
+                    self.demux_chunks(iter(()), start, splits, canon, limiter)
+                    ranges.pop(0)
+                    continue
+
+                rf = dl_session.get(
+                    url,
+                    headers={"User-Agent": user_agent, "Range": f"bytes={start}-{end - 1}"},
+                    stream=True,
+                    timeout=REQUEST_TIMEOUT,
+                )
+                rf.raise_for_status()
+                if rf.status_code == 206:
+                    offset = start
+                    ranges.pop(0)
+                else:
+                    offset = 0
+                    splits = [split for r in ranges for split in r[2]]
+                    ranges = []
+
+                self.demux_chunks(rf.iter_content(chunk_size=READ_CHUNK), offset, splits, canon, limiter)
+                rf.close()
+            return
+
+        have = self._staged_length(canon, job.size)
+        headers = {"User-Agent": user_agent}
+        if have:
+            headers["Range"] = f"bytes={have}-"
+        rf = dl_session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+        rf.raise_for_status()
+        base = have if rf.status_code == 206 else 0
+
+        final_dest, tmp_target, have = self._allocate_file(canon, job.size)
+        skip = have - base
+        with tmp_target:
+            for chunk in rf.iter_content(chunk_size=READ_CHUNK):
+                self.progress.advance(canon, len(chunk))
+                wait = limiter.delay(len(chunk))
+                if wait:
+                    time.sleep(wait)
+                if skip:
+                    # The server sent bytes we already have.
+                    drop = min(skip, len(chunk))
+                    chunk = chunk[drop:]
+                    skip -= drop
+                tmp_target.write(chunk)
+            length = tmp_target.tell()
+        rf.close()
+
+        if length != job.size:
+            # The connection closed early without an error. Keep what we have, the next
+            # attempt resumes from there.
+            raise requests.exceptions.ChunkedEncodingError(f"{canon}: got {length} of {job.size} bytes")
+        self._finish_file(tmp_target, final_dest, canon)
+
+    def download_with_requests(self, signer, count, rate_limit=None):
         dl_session = requests.Session()
+        limiter = BandwidthLimiter(rate_limit)
 
-        for i, (job, url) in enumerate(jobs):
-            canon = job.name
-            LOGGER.info("(%d/%d) Retrieving %s...", i + 1, count, canon)
-            rf = dl_session.get(url, headers={"User-Agent": user_agent})
-
-            if job.is_meta:
-                bio = io.BytesIO(rf.content)
-                for split in job.splits:
-                    bio.seek(split.offset)
-                    LOGGER.debug("    %s...", split.name)
-
-                    final_dest, tmp_target = self._allocate_file(split.name)
-                    with tmp_target:
-                        tmp_target.write(bio.read(split.size))
-                    
-                    self._move_file_into_place(tmp_target.name, final_dest)
-                    self.package_state.add(split.name)
-            else:
-                final_dest, tmp_target = self._allocate_file(canon)
-                with tmp_target:
-                    for chunk in rf.iter_content(chunk_size=0x10000):
-                        tmp_target.write(chunk)
+        # Reads block, so report from another thread, or a big package (or a stalled
+        # one) would go unreported until it's done.
+        stop_reporting = threading.Event()
+
+        def report_progress():
+            while not stop_reporting.wait(1.0):
+                self.progress.report()
+
+        reporter = threading.Thread(target=report_progress, daemon=True)
+        reporter.start()
+
+        try:
+            i = 0
+            for future in signer.batches:
+                for job, url in future.result():
+                    i += 1
+                    LOGGER.info("(%d/%d) Retrieving %s...", i, count, job.name)
+                    for attempt in range(DOWNLOAD_ATTEMPTS):
+                        self.progress.start(job.name, self._remaining_size(job))
+                        try:
+                            self.fetch_with_requests(dl_session, job, url, signer.user_agent, limiter)
+                            self.progress.finish(job.name)
+                            break
+                        except Exception as e:
+                            self.progress.finish(job.name, completed=False)
+                            status = e.response.status_code if isinstance(e, requests.HTTPError) else None
+                            if status is not None:
+                                retryable = status in (403, 429) or status >= 500
+                            else:
+                                retryable = isinstance(
+                                    e,
+                                    (
+                                        requests.ConnectionError,
+                                        requests.Timeout,
+                                        requests.exceptions.ChunkedEncodingError,
+                                    ),
+                                )
+                            if not retryable or attempt + 1 == DOWNLOAD_ATTEMPTS:
+                                raise
+                            if status == 403:
+                                LOGGER.info("URL for %s expired, signing it again.", job.name)
+                                url = signer.resign(job.name).result()
+                                continue
+                            # Downloads here are one at a time, so back off by waiting
+                            # rather than with fewer workers like download_with_aiohttp.
+                            LOGGER.warning("Retrieving %s failed (%s), will retry.", job.name, e)
+                            time.sleep(RETRY_DELAY * 2 ** attempt)
+
+                    if self.commit_stage.due():
+                        self.commit_stage.flush()
+        finally:
+            stop_reporting.set()
+            reporter.join()
+            dl_session.close()
 
-                self._move_file_into_place(tmp_target.name, final_dest)
-                self.package_state.add(canon)
 
-        dl_session.close()
+def download_shard(
+    master, search_paths, locations, shard, user_agent, workers, rate_limit, log_level, jobs_in, results_out
+):
+    """Entry point of the worker processes started by PackageManager.download_sharded."""
+    logging.basicConfig(level=log_level)
+    feed = ShardFeed(shard, jobs_in, results_out, user_agent)
+    try:
+        manager = PackageManager(master, search_paths, use_index=False, use_store=False, locations=locations)
+        # Hand finished files to the parent instead of publishing them here.
+        manager.commit_stage = CommitStage(feed.publish, "none")
+        manager.progress = DownloadProgress(interval=2.0, sink=feed.send_progress)
+        asyncio.run(manager.download_with_aiohttp(feed, 0, workers, rate_limit))
+        manager.progress.report(force=True)
+        results_out.put(("exit", shard, None))
+    except BaseException:
+        results_out.put(("error", shard, traceback.format_exc()))
+    finally:
+        feed.close()
@@ -1,5 +1,9 @@
 import os
+import sys
+import json
 import logging
+import argparse
+from contextlib import contextmanager
 from typing import Optional
 
 import plac
@@ -8,18 +12,80 @@ from . import pkg
 
 LOGGER = logging.getLogger("astool.pkg.cli")
 
+SYNC_STATE_FILE = "sync_state.json"
+
+
+def parse_byte_rate(text: Optional[str]) -> Optional[int]:
+    """Parse a rate like "500K" or "20M" (bytes per second, powers of 1024).
+    Raises ArgumentTypeError if it isn't one, so it can be used as an option's type."""
+    if not text:
+        return None
+
+    number = text
+    multiplier = 1
+    suffix = text[-1].upper()
+    if suffix in "KMG":
+        multiplier = 1024 ** ("KMG".index(suffix) + 1)
+        number = text[:-1]
+
+    try:
+        rate = int(float(number) * multiplier)
+    except (ValueError, OverflowError):
+        rate = -1
+    if rate < 0:
+        raise argparse.ArgumentTypeError(
+            f"invalid rate {text!r}, expected bytes per second like 500000, 500K, 20M or 1G"
+        )
+    return rate
+
 
 class PackageManagerMain(object):
     def __init__(self, context):
         self.context = context
 
+    @contextmanager
+    def fresh_iceapi(self):
+        ice = self.context.get_iceapi()
+        try:
+            yield ice
+        finally:
+            self.context.release_iceapi(ice)
+
+    def find_asset_db(self, master: str, lang: str) -> Optional[str]:
+        path = os.path.join(self.context.masters, master, f"asset_i_{lang}_0.db")
+        if not os.path.exists(path):
+            path = os.path.join(self.context.masters, master, f"asset_i_{lang}.db")
+        return path if os.path.exists(path) else None
+
+    @contextmanager
+    def sync_state(self):
+        """The master each set of groups was last completely synced with, keyed by sync_key.
+        Anything that deletes or moves packages has to clear it."""
+        path = os.path.join(self.context.cache, SYNC_STATE_FILE)
+        try:
+            with open(path, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+        original = dict(state)
+
+        yield state
+
+        if state != original:
+            with open(path, "w") as f:
+                json.dump(state, f)
+
+    @staticmethod
+    def sync_key(lang: str, groups) -> str:
+        return json.dumps([lang] + sorted(groups))
+
     def write_signal(self, signal_pth: Optional[str]):
         if signal_pth is not None:
             with open(signal_pth, "wb") as sigf:
                 sigf.write(b"ready\n")
                 sigf.flush()
 
-    def sync(self, master, validate_only, signal_pth, quiet, lang, *groups):
+    def sync(self, master, validate_only, signal_pth, quiet, lang, *groups, workers=None, rate_limit=None, verify=False, durability=None, processes=None, progress_json=None, full=False):
         """Download or validate package groups."""
         if not lang:
             lang = self.context.server_config.get("language", "ja")
@@ -33,47 +99,66 @@ class PackageManagerMain(object):
             self.write_signal(signal_pth)
             return
 
-        path = os.path.join(self.context.masters, master, f"asset_i_{lang}_0.db")
-        if not os.path.exists(path):
-            path = os.path.join(self.context.masters, master, f"asset_i_{lang}.db")
-
-        if not os.path.exists(path):
+        path = self.find_asset_db(master, lang)
+        if not path:
             LOGGER.critical("Can't find asset DB.")
             self.write_signal(signal_pth)
             return
 
-        manager = pkg.PackageManager(path, (self.context.cache,))
+        manager = pkg.PackageManager(path, self.context.cache_roots)
 
         LOGGER.info("Master: %s", master)
         LOGGER.info("Packages on disk: %d", len(manager.package_state))
 
+        damaged = set()
+        if verify:
+            checked, damaged = manager.verify_packages()
+            LOGGER.info("Verified %d packages, %d have the wrong size.", checked, len(damaged))
+            for pack in sorted(damaged):
+                LOGGER.warning("Damaged package: %s", pack)
+                if not validate_only:
+                    manager.remove_package(pack)
+            manager.flush_indexes()
+            if damaged and not validate_only:
+                # Other sets of groups may have needed them too.
+                with self.sync_state() as state:
+                    state.clear()
+
         download_tasks = []
         wanted_packages = set()
         resolve_mode = 1
 
+        key = self.sync_key(lang, groups)
+        with self.sync_state() as state:
+            last_master = state.get(key)
+        last_asset_db = self.find_asset_db(last_master, lang) if last_master else None
+
         if len(groups) == 1 and groups[0] == "everything":
-            packages = manager.lookup_all_package_groups()
+            patterns = None
         elif groups[0] == "@":
             resolve_mode = 2
             wanted_packages = manager.prune_package_list(list(groups[1:]))
         else:
-            packages = manager.lookup_matching_package_groups(groups)
+            patterns = groups
 
-        if resolve_mode == 1:
+        # -n always gets the full report.
+        if resolve_mode == 1 and last_asset_db and not full and not damaged and not validate_only:
+            # Everything the groups needed was there after the last sync, so only packages
+            # that are new since that master can be missing, unless something deleted them.
+            LOGGER.info("Checking what changed since master %s (use -F to check everything)...", last_master)
+            wanted_packages = manager.changed_packages(last_asset_db, patterns)
+        elif resolve_mode == 1:
             LOGGER.info("Validating packages...")
-            for package_group in packages:
-                have, donthave = manager.get_package_group(package_group)
-
-                if donthave:
+            counts, wanted_packages = manager.validate_package_groups(patterns)
+            for package_group, have, total in counts:
+                if have < total:
                     print(f"Validating '{package_group}'...", end=" ")
                     print("\x1b[31m", end="")
-                    print(f"{len(have)}/{len(have) + len(donthave)} \x1b[0m")
+                    print(f"{have}/{total} \x1b[0m")
                 elif not quiet:
                     print(f"Validating '{package_group}'...", end=" ")
                     print("\x1b[32m", end="")
-                    print(f"{len(have)}/{len(have) + len(donthave)} \x1b[0m")
-
-                wanted_packages.update(donthave)
+                    print(f"{have}/{total} \x1b[0m")
         else:
             LOGGER.info("Proceeding in direct mode.")
 
@@ -86,10 +171,7 @@ class PackageManagerMain(object):
                 for x in download_tasks
             )
             LOGGER.info("  %d new packages,", npkg)
-            nbytes = sum(
-                x.size if isinstance(x, pkg.PackageDownloadTask) else sum(y.size for y in x.splits)
-                for x in download_tasks
-            )
+            nbytes = sum(pkg.download_task_size(x) for x in download_tasks)
             LOGGER.info("  %d bytes, (%d MB).", nbytes, nbytes / (1024 * 1024))
         else:
             LOGGER.info("All packages are up to date. There is nothing to do.")
@@ -101,10 +183,37 @@ class PackageManagerMain(object):
                 self.write_signal(signal_pth)
                 self.context.release_iceapi(ice)
 
-            manager.execute_job_list(ice, download_tasks, done=on_iceapi_release)
+            if progress_json == "-":
+                progress_out = sys.stdout
+            elif progress_json:
+                progress_out = open(progress_json, "a")
+            else:
+                progress_out = None
+
+            try:
+                manager.execute_job_list(
+                    ice,
+                    download_tasks,
+                    done=on_iceapi_release,
+                    workers=workers,
+                    rate_limit=rate_limit,
+                    # Once we've signalled that we're done with the API, someone else may be using
+                    # the account, so only log in again for expired URLs if nobody is waiting.
+                    reacquire=self.fresh_iceapi if signal_pth is None else None,
+                    durability=durability or "batch",
+                    processes=processes or 1,
+                    progress=pkg.DownloadProgress(json_out=progress_out),
+                )
+            finally:
+                if progress_out is not None and progress_out is not sys.stdout:
+                    progress_out.close()
         else:
             self.write_signal(signal_pth)
 
+        if resolve_mode == 1 and not (download_tasks and validate_only):
+            with self.sync_state() as state:
+                state[key] = master
+
     def gc(self, master, dry_run, lang):
         """Delete unreferenced packages."""
         if not lang:
@@ -114,15 +223,12 @@ class PackageManagerMain(object):
             with self.context.enter_memo() as memo:
                 master = memo["master_version"]
 
-        path = os.path.join(self.context.masters, master, f"asset_i_{lang}_0.db")
-        if not os.path.exists(path):
-            path = os.path.join(self.context.masters, master, f"asset_i_{lang}.db")
-
-        if not os.path.exists(path):
+        path = self.find_asset_db(master, lang)
+        if not path:
             LOGGER.critical("Can't find asset DB.")
             return
 
-        manager = pkg.PackageManager(path, (self.context.cache,))
+        manager = pkg.PackageManager(path, self.context.cache_roots)
 
         LOGGER.info("Master: %s", master)
         LOGGER.info("Packages on disk: %d", len(manager.package_state))
@@ -133,9 +239,13 @@ class PackageManagerMain(object):
             freeable += os.path.getsize(manager.lookup_file(pack))
             if not dry_run:
                 LOGGER.info("Removing %s...", pack)
-                fqpkg = manager.lookup_file(pack)
-                if fqpkg:
-                    os.unlink(fqpkg)
+                manager.remove_package(pack)
+
+        manager.flush_indexes()
+        if garbage and not dry_run:
+            # Groups of other masters or languages may have lost packages.
+            with self.sync_state() as state:
+                state.clear()
 
         LOGGER.info(
             "%d bytes (%d MB) %s freed by deleting these unused packages.",
@@ -143,3 +253,66 @@ class PackageManagerMain(object):
             freeable / (1024 * 1024),
             "can be" if dry_run else "were",
         )
+
+    def dedupe(self, master, lang):
+        """Move the cache's packages into the package store."""
+        if not lang:
+            lang = self.context.server_config.get("language", "ja")
+
+        if not master:
+            with self.context.enter_memo() as memo:
+                master = memo["master_version"]
+
+        path = self.find_asset_db(master, lang)
+        if not path:
+            LOGGER.critical("Can't find asset DB.")
+            return
+
+        manager = pkg.PackageManager(path, self.context.cache_roots)
+        if not manager.store:
+            LOGGER.critical("Set ASTOOL_PACKAGE_STORE to the directory to keep the package store in.")
+            return
+
+        LOGGER.info("Packages on disk: %d", len(manager.package_state))
+        moved, saved = manager.dedupe_packages()
+        LOGGER.info("%d packages moved into the store, %d bytes (%d MB) saved.", moved, saved, saved / (1024 * 1024))
+
+        pruned, freed = manager.store.prune()
+        if pruned:
+            LOGGER.info(
+                "%d files (%d MB) no cache was using were removed from the store.", pruned, freed / (1024 * 1024)
+            )
+
+    def promote(self, master, lang, demote, *groups):
+        """Move package groups to the fastest cache, or back to the main one."""
+        if not lang:
+            lang = self.context.server_config.get("language", "ja")
+
+        if not master:
+            with self.context.enter_memo() as memo:
+                master = memo["master_version"]
+
+        path = self.find_asset_db(master, lang)
+        if not path:
+            LOGGER.critical("Can't find asset DB.")
+            return
+
+        if len(self.context.cache_roots) < 2:
+            LOGGER.critical("Set ASTOOL_FAST_CACHE to the storage directory to promote packages to.")
+            return
+
+        manager = pkg.PackageManager(path, self.context.cache_roots)
+        packs = set()
+        for package_group in manager.lookup_matching_package_groups(groups):
+            have, _ = manager.get_package_group(package_group)
+            packs.update(have)
+
+        target = len(manager.search_paths) - 1 if demote else 0
+        moved, nbytes = manager.promote_packages(packs, target)
+        if moved:
+            # Packages that aren't where they were are missing for a run with other storage settings.
+            with self.sync_state() as state:
+                state.clear()
+        LOGGER.info(
+            "%d packages (%d MB) moved to %s.", moved, nbytes / (1024 * 1024), manager.search_paths[target]
+        )
@@ -0,0 +1,159 @@
+import os
+import errno
+import sqlite3
+import hashlib
+import logging
+from typing import Optional, Tuple
+
+LOGGER = logging.getLogger("astool.pkgstore")
+
+HASH_CHUNK = 0x100000
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PackageStore(object):
+    """A content-addressed store of package files that can be shared between caches.
+
+    Every file is kept once, under the SHA-256 of its contents, and the pkgX entries of
+    each cache using the store are hard links to it. Package names are remembered along
+    with their size, so a package that one region (or account) already has can be linked
+    into another cache without downloading it again.
+
+    Hard links can't cross filesystems, so the store has to be on the same one as the
+    caches. Files that can't be linked are left alone.
+    """
+
+    FILENAME = "store.db"
+
+    def __init__(self, root: str):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        os.makedirs(self.objects, exist_ok=True)
+        # Several astool processes can use the same store.
+        self.db = sqlite3.connect(os.path.join(root, self.FILENAME), timeout=60)
+        self.db.execute("CREATE TABLE IF NOT EXISTS names (name TEXT, size INTEGER, sha TEXT, PRIMARY KEY (name, size))")
+        self.db.commit()
+        self.warned_cross_device = False
+
+    def blob_path(self, sha: str) -> str:
+        return os.path.join(self.objects, sha[:2], sha)
+
+    def lookup(self, name: str, size: int) -> Optional[str]:
+        """The path of the stored copy of a package, if there is one."""
+        row = self.db.execute("SELECT sha FROM names WHERE name = ? AND size = ?", (name, size)).fetchone()
+        if not row:
+            return None
+
+        path = self.blob_path(row[0])
+        try:
+            if os.path.getsize(path) == size:
+                return path
+        except FileNotFoundError:
+            pass
+        self.db.execute("DELETE FROM names WHERE name = ? AND size = ?", (name, size))
+        return None
+
+    def link_out(self, name: str, size: int, dest: str) -> bool:
+        """Hard link the stored copy of a package to dest. Returns False if there isn't one."""
+        blob = self.lookup(name, size)
+        if not blob:
+            return False
+
+        try:
+            os.link(blob, dest)
+        except FileExistsError:
+            return False
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            self._warn_cross_device(dest)
+            return False
+        return True
+
+    def is_linked(self, name: str, path: str) -> bool:
+        """Whether path is already a link to the stored copy of name."""
+        st = os.stat(path)
+        if st.st_nlink < 2:
+            return False
+        blob = self.lookup(name, st.st_size)
+        return blob is not None and os.path.samestat(st, os.stat(blob))
+
+    def adopt(self, name: str, path: str, sha: Optional[str] = None) -> int:
+        """Put the package at path into the store.
+
+        If the store already has the same contents, path is replaced by a link to them.
+        Otherwise path itself becomes the stored copy. Returns the number of bytes saved.
+        """
+        size = os.path.getsize(path)
+        if sha is None:
+            sha = hash_file(path)
+        blob = self.blob_path(sha)
+        saved = 0
+
+        try:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+            except FileExistsError:
+                st_blob, st_path = os.stat(blob), os.stat(path)
+                if not os.path.samestat(st_blob, st_path):
+                    # Link to a temporary name and rename it over the package, so it never goes missing.
+                    tmp = os.path.join(self.root, f"{sha}.{os.getpid()}.tmp")
+                    try:
+                        os.unlink(tmp)
+                    except FileNotFoundError:
+                        pass
+                    os.link(blob, tmp)
+                    os.rename(tmp, path)
+                    # Only count it if nothing else was holding on to the old file.
+                    if st_path.st_nlink == 1:
+                        saved = size
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            self._warn_cross_device(path)
+            return 0
+
+        self.db.execute("INSERT OR REPLACE INTO names VALUES (?, ?, ?)", (name, size, sha))
+        return saved
+
+    def prune(self) -> Tuple[int, int]:
+        """Delete stored files no cache links to any more. Returns (files, bytes) removed."""
+        count = nbytes = 0
+        gone = set()
+        for prefix in os.listdir(self.objects):
+            prefix_dir = os.path.join(self.objects, prefix)
+            for sha in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, sha)
+                st = os.stat(path)
+                if st.st_nlink == 1:
+                    os.unlink(path)
+                    gone.add(sha)
+                    count += 1
+                    nbytes += st.st_size
+
+        self.db.executemany("DELETE FROM names WHERE sha = ?", ((sha,) for sha in gone))
+        self.commit()
+        return count, nbytes
+
+    def _warn_cross_device(self, path: str):
+        if not self.warned_cross_device:
+            LOGGER.warning("%s is on a different filesystem than the package store at %s, not sharing it.", path, self.root)
+            self.warned_cross_device = True
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
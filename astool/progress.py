@@ -0,0 +1,179 @@
+import json
+import time
+import logging
+import threading
+from typing import Optional, Dict, Iterable, TextIO, Callable
+
+LOGGER = logging.getLogger("astool.progress")
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class DownloadProgress(object):
+    """Keeps byte counters for a package download and reports on them.
+
+    Download workers call start/advance/finish for each task, with sizes counting only
+    what is left to fetch. If a task is started again with less left than before, the
+    difference was kept from the earlier attempt and counts as received; whatever else a
+    failed attempt received is taken back, since it will be fetched again. report() logs
+    the overall progress, throughput, an ETA from the known task sizes, and the slowest
+    and stalled tasks in flight, at most once per interval. It may be called from
+    another thread than the workers. If json_out is given, every report is also written
+    to it as one line of JSON.
+
+    Worker processes use a sink instead: report() then passes snapshot() to it, and the
+    parent feeds it to merge() so its reports cover all of the workers.
+    """
+
+    # Tasks that haven't received anything for this long are reported as stalled.
+    STALL_AFTER = 30.0
+    # How many of the slowest tasks to name in each report.
+    SLOWEST_COUNT = 3
+    # Weight of the newest sample in the smoothed throughput.
+    SMOOTHING = 0.3
+
+    def __init__(
+        self, interval: float = 10.0, json_out: Optional[TextIO] = None, sink: Optional[Callable[[dict], None]] = None
+    ):
+        self.interval = interval
+        self.json_out = json_out
+        self.sink = sink
+        self.total_bytes = 0
+        self.total_jobs = 0
+        self.received = 0
+        self.jobs_done = 0
+        # name -> [size, received, started, last data]
+        self.inflight: Dict[str, list] = {}
+        # name -> size the task had left when it was last started
+        self.expected: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.remote: Dict[int, dict] = {}
+
+        self.last_report = time.monotonic()
+        self.last_received = 0
+        self.rate: Optional[float] = None
+
+    def add_jobs(self, sizes: Iterable[int]):
+        for size in sizes:
+            self.total_bytes += size
+            self.total_jobs += 1
+
+    def start(self, name: str, size: int):
+        now = time.monotonic()
+        with self.lock:
+            previous = self.expected.get(name)
+            if previous is not None and size < previous:
+                self.received += previous - size
+            self.expected[name] = size
+            self.inflight[name] = [size, 0, now, now]
+
+    def advance(self, name: str, nbytes: int):
+        self.received += nbytes
+        task = self.inflight.get(name)
+        if task:
+            task[1] += nbytes
+            task[3] = time.monotonic()
+
+    def finish(self, name: str, completed: bool = True):
+        with self.lock:
+            task = self.inflight.pop(name, None)
+            if completed:
+                self.jobs_done += 1
+            elif task:
+                self.received -= task[1]
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "received": self.received,
+                "jobs_done": self.jobs_done,
+                # Ages rather than timestamps, so they mean the same thing in another process.
+                "inflight": [
+                    [name, size, received, now - started, now - last]
+                    for name, (size, received, started, last) in self.inflight.items()
+                ],
+            }
+
+    def merge(self, key: int, snapshot: dict):
+        self.remote[key] = snapshot
+
+    def report(self, force: bool = False):
+        now = time.monotonic()
+        elapsed = now - self.last_report
+        if not force and elapsed < self.interval:
+            return
+
+        if self.sink:
+            self.last_report = now
+            self.sink(self.snapshot())
+            return
+
+        snapshots = [self.snapshot()] + list(self.remote.values())
+        received = sum(snap["received"] for snap in snapshots)
+        jobs_done = sum(snap["jobs_done"] for snap in snapshots)
+        inflight = [task for snap in snapshots for task in snap["inflight"]]
+
+        if elapsed > 0:
+            sample = (received - self.last_received) / elapsed
+            if self.rate is None:
+                self.rate = sample
+            else:
+                self.rate = self.SMOOTHING * sample + (1 - self.SMOOTHING) * self.rate
+        self.last_report = now
+        self.last_received = received
+
+        remaining = max(0, self.total_bytes - received)
+        eta = remaining / self.rate if self.rate else None
+        stalled = sorted((task for task in inflight if task[4] >= self.STALL_AFTER), key=lambda t: -t[4])
+        # Only rank tasks that have been running long enough for their rate to mean something.
+        slowest = sorted(
+            (task for task in inflight if task[3] >= self.STALL_AFTER / 3 and task[4] < self.STALL_AFTER),
+            key=lambda t: t[2] / t[3],
+        )[: self.SLOWEST_COUNT]
+
+        LOGGER.info(
+            "%d/%d MB (%.1f%%), %d/%d jobs, %.1f MB/s, ETA %s, %d in flight",
+            received / 1048576,
+            self.total_bytes / 1048576,
+            100 * min(1.0, received / self.total_bytes) if self.total_bytes else 100.0,
+            jobs_done,
+            self.total_jobs,
+            (self.rate or 0) / 1048576,
+            format_eta(eta),
+            len(inflight),
+        )
+        for name, _, _, _, idle in stalled:
+            LOGGER.warning("  %s has had no data for %d s", name, idle)
+        if slowest:
+            LOGGER.info(
+                "  Slowest: %s", ", ".join(f"{name} ({got / age / 1024:.0f} KB/s)" for name, _, got, age, _ in slowest)
+            )
+
+        if self.json_out:
+            self.json_out.write(
+                json.dumps(
+                    {
+                        "time": time.time(),
+                        "received_bytes": received,
+                        "total_bytes": self.total_bytes,
+                        "jobs_done": jobs_done,
+                        "total_jobs": self.total_jobs,
+                        "bytes_per_second": self.rate,
+                        "eta_seconds": eta,
+                        "inflight": len(inflight),
+                        "stalled": [{"name": t[0], "idle_seconds": t[4]} for t in stalled],
+                        "slowest": [
+                            {"name": t[0], "size": t[1], "received": t[2], "bytes_per_second": t[2] / t[3]}
+                            for t in slowest
+                        ],
+                    }
+                )
+                + "\n"
+            )
+            self.json_out.flush()
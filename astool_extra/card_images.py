@@ -53,17 +53,16 @@ def save_img(pm: pkg.PackageManager, name: str, key: str):
         if os.path.exists(name):
             return
 
-        buf = bytearray(size)
-        with open(pm.lookup_file(pack), "rb") as src:
-            src.seek(off)
-            src.readinto(buf)
         keyset = hwdecrypt.Keyset(k1, k2, 0x3039)
-        hwdecrypt.decrypt(keyset, buf)
-
-        with open(name, "wb") as dst:
-            dst.write(buf)
+        with open(pm.lookup_file(pack), "rb") as src, open(name, "wb") as dst:
+            got = hwdecrypt.decrypt_file_range(keyset, src.fileno(), off, size, dst.fileno())
+        if got != size:
+            raise ValueError(f"{pack} is truncated, only got {got} of {size} bytes for {key}")
     except Exception as e:
         print(e)
+        # Don't leave a partial file behind, it would be skipped next time.
+        if os.path.exists(name):
+            os.unlink(name)
 
 
 def main(
@@ -87,7 +86,7 @@ def main(
     data_db = sqlite3.connect(f"file:{md_path}?mode=ro", uri=True)
 
     pm = pkg.PackageManager(
-        os.path.join(context.masters, master, "asset_i_ja.db"), [context.cache]
+        os.path.join(context.masters, master, "asset_i_ja.db"), context.cache_roots
     )
 
     to_gather = []
@@ -1,5 +1,6 @@
 import os
 import sys
+import asyncio
 import logging
 import json
 import time
@@ -12,6 +13,7 @@ def main(
     bundle: ("Bundle version", "option", "b"),
     quiet: ("Disable logging?", "flag", "q"),
     memo: ("Name of the memo file to use. Default is 'astool_store'.", "option", "f"),
+    concurrency: ("Profiles to fetch at once (needs aiohttp). Default is 1.", "option", "j", int),
     *uids: "user ids"
 ):
     if not quiet:
@@ -22,14 +24,30 @@ def main(
 
     ice = context.get_iceapi()
 
-    for uid in uids:
-        print(uid)
-        resp = ice.api.userProfile.fetchProfile({"user_id": uid})
-        with open(f"{uid}.json", "w") as out:
-            json.dump(resp.app_data, out)
-        time.sleep(0.3)
+    try:
+        if concurrency and concurrency > 1:
+            asyncio.run(fetch_concurrently(ice, uids, concurrency))
+        else:
+            for uid in uids:
+                print(uid)
+                resp = ice.api.userProfile.fetchProfile({"user_id": uid})
+                save_profile(uid, resp)
+                time.sleep(0.3)
+    finally:
+        context.release_iceapi(ice)
 
-    context.release_iceapi(ice)
+def save_profile(uid, resp):
+    with open(f"{uid}.json", "w") as out:
+        json.dump(resp.app_data, out)
+
+async def fetch_concurrently(ice, uids, concurrency):
+    async with iceapi.AsyncICEBinder(ice, concurrency) as aice:
+        async def fetch(uid):
+            resp = await aice.api.userProfile.fetchProfile({"user_id": uid})
+            print(uid)
+            save_profile(uid, resp)
+
+        await asyncio.gather(*(fetch(uid) for uid in uids))
 
 if __name__ == '__main__':
     import plac
@@ -32,17 +32,15 @@ def save_img(pm: pkg.PackageManager, table: str, name: str, key: str, fbindir: s
 
     if not os.path.exists(real_stor_path):
         try:
-            buf = bytearray(size)
-            with open(pm.lookup_file(pack), "rb") as src:
-                src.seek(off)
-                src.readinto(buf)
             keyset = hwdecrypt.Keyset(k1, k2, 0x3039)
-            hwdecrypt.decrypt(keyset, buf)
-
-            with open(real_stor_path, "wb") as dst:
-                dst.write(buf)
+            with open(pm.lookup_file(pack), "rb") as src, open(real_stor_path, "wb") as dst:
+                got = hwdecrypt.decrypt_file_range(keyset, src.fileno(), off, size, dst.fileno())
+            if got != size:
+                raise ValueError(f"{pack} is truncated")
         except Exception as e:
             print("warn: missing:", name)
+            if os.path.exists(real_stor_path):
+                os.unlink(real_stor_path)
 
     if fbindir:
         # FIXME: hack for docker :(
@@ -116,7 +114,7 @@ def main(
     data_db = sqlite3.connect(f"file:{md_path}?mode=ro", uri=True)
 
     pm = pkg.PackageManager(
-        os.path.join(context.masters, master, "asset_i_ja.db"), [context.cache]
+        os.path.join(context.masters, master, "asset_i_ja.db"), context.cache_roots
     )
 
     fbindir = os.path.join(output, "storage")
@@ -87,7 +87,7 @@ def main(
     data_db = sqlite3.connect(f"file:{md_path}?mode=ro", uri=True)
 
     pm = pkg.PackageManager(
-        os.path.join(context.masters, master, f"asset_i_{lang}.db"), [context.cache]
+        os.path.join(context.masters, master, f"asset_i_{lang}.db"), context.cache_roots
     )
 
     to_gather = []
@@ -5,13 +5,18 @@ import shutil
 import logging
 import sqlite3
 import struct
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 
 from astool import pkg, ctx
 import hwdecrypt
 import plac
 
 LOGGER = logging.getLogger("astool.unpack_fs")
+# Segments are read until about this many bytes are waiting, then decrypted together.
+BATCH_BYTES = 32 * 1024 * 1024
+DECRYPT_THREADS = min(os.cpu_count() or 1, 4)
+# Segments this big are decrypted from the package to the output file without loading them.
+STREAM_BYTES = 4 * 1024 * 1024
 
 def to_unsigned(i):
     return struct.unpack("<I", struct.pack("<i", i))[0]
@@ -35,6 +40,9 @@ class DecryptFileSegment(Action):
         - ext: file extension, without leading period.
         - encode_filenames: whether to base32-encode the asset_path (some tables like adv_script have plain names)
     """
+    log_missing = True
+    stream_large_files = True
+
     def __init__(self, ext: str, encode_filenames=True):
         self.ext = ext
         self.encode_filenames = encode_filenames
@@ -58,59 +66,80 @@ class DecryptFileSegment(Action):
                 (pack_name, head, size, key1, key2)
             )
     
+    def output_name(self, job: Job, buf: Optional[bytearray]) -> str:
+        return job.asset_name + f".{self.ext}"
+
+    def write_batch(self, batch: "List[Tuple[Job, hwdecrypt.Keyset, bytearray]]", stage_dir: str):
+        hwdecrypt.decrypt_many([(keyset, buf) for _, keyset, buf in batch], threads=DECRYPT_THREADS)
+        for job, _, buf in batch:
+            with open(os.path.join(stage_dir, self.output_name(job, buf)), "wb") as dst:
+                dst.write(buf)
+
     def perform_jobs(self, job_list: List[Job], manager: pkg.PackageManager, stage_dir: str):
+        # Small segments are read into memory and decrypted in batches of about BATCH_BYTES.
+        # Large ones are decrypted straight from the package into the output file.
+        batch = []
+        batch_bytes = 0
         for job in job_list:
             pack_name, head, size, key1, key2 = job.extra
-            buf = bytearray(size)
             keyset = hwdecrypt.Keyset(to_unsigned(key1), to_unsigned(key2), 0x3039)
 
             real_pkg = manager.lookup_file(pack_name)
             if not real_pkg:
-                LOGGER.warning("Missing package %s for job %s, skipping.", pack_name, job.asset_name)
+                if self.log_missing:
+                    LOGGER.warning("Missing package %s for job %s, skipping.", pack_name, job.asset_name)
+                continue
+
+            if self.stream_large_files and size >= STREAM_BYTES:
+                out_path = os.path.join(stage_dir, self.output_name(job, None))
+                with open(real_pkg, "rb") as src, open(out_path, "wb") as dst:
+                    got = hwdecrypt.decrypt_file_range(keyset, src.fileno(), head, size, dst.fileno())
+                if got != size:
+                    # Don't leave a short file behind that looks like a good one.
+                    os.unlink(out_path)
+                    LOGGER.warning("Package %s is truncated (%d of %d bytes), skipping job %s.", pack_name, got, size, job.asset_name)
                 continue
 
+            buf = bytearray(size)
             with open(real_pkg, "rb") as src:
                 src.seek(head)
-                src.readinto(buf)
-            
-            hwdecrypt.decrypt(keyset, buf)
-            with open(os.path.join(stage_dir, job.asset_name + f".{self.ext}"), "wb") as dst:
-                dst.write(buf)
+                got = src.readinto(buf)
+            if got != size:
+                LOGGER.warning("Package %s is truncated (%d of %d bytes), skipping job %s.", pack_name, got, size, job.asset_name)
+                continue
+
+            batch.append((job, keyset, buf))
+            batch_bytes += size
+            if batch_bytes >= BATCH_BYTES:
+                self.write_batch(batch, stage_dir)
+                batch = []
+                batch_bytes = 0
+
+        if batch:
+            self.write_batch(batch, stage_dir)
 
 class DecryptTexture(DecryptFileSegment):
     """Specific for texture table. Does the same thing as DecryptFileSegment, but identifies file type
         based on file signatures and adds the appropriate extension.
         Configuration: None.
     """
+    log_missing = False
+    # The file type is sniffed from the decrypted data, so it has to be in memory.
+    stream_large_files = False
+
     def __init__(self):
         super().__init__("?", True)
 
-    def perform_jobs(self, job_list: List[Job], manager: pkg.PackageManager, stage_dir: str):
-        for job in job_list:
-            pack_name, head, size, key1, key2 = job.extra
-            buf = bytearray(size)
-            keyset = hwdecrypt.Keyset(to_unsigned(key1), to_unsigned(key2), 0x3039)
+    def output_name(self, job: Job, buf: bytearray) -> str:
+        if buf[:2] == b"\xFF\xD8":
+            ext = "jpg"
+        elif buf[:4] == b"\x89\x50\x4E\x47":
+            ext = "png"
+        else:
+            LOGGER.warning("Cannot identify file: %s.", job.asset_name)
+            ext = "unknown_texture"
 
-            real_pkg = manager.lookup_file(pack_name)
-            if not real_pkg:
-                #LOGGER.warning("Missing package %s for job %s, skipping.", pack_name, job.asset_name)
-                continue
-
-            with open(real_pkg, "rb") as src:
-                src.seek(head)
-                src.readinto(buf)
-            
-            hwdecrypt.decrypt(keyset, buf)
-            if buf[:2] == b"\xFF\xD8":
-                ext = "jpg"
-            elif buf[:4] == b"\x89\x50\x4E\x47":
-                ext = "png"
-            else:
-                LOGGER.warning("Cannot identify file: %s.", job.asset_name)
-                ext = "unknown_texture"
-
-            with open(os.path.join(stage_dir, job.asset_name + f".{ext}"), "wb") as dst:
-                dst.write(buf)
+        return job.asset_name + f".{ext}"
 
 class CopyAudioBankFilePair(Action):
     """Specific for m_asset_sound table. Copies ACB/AWB bank pairs.
@@ -276,7 +305,7 @@ def unpack_all(context: ctx.ASContext, master: str, lang: str, table_list: Optio
         LOGGER.critical("Can't find asset DB.")
         return
 
-    manager = pkg.PackageManager(path, (context.cache,))
+    manager = pkg.PackageManager(path, context.cache_roots)
 
     LOGGER.info("Master: %s", master)
     LOGGER.info("Packages on disk: %d", len(manager.package_state))
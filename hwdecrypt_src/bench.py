@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Throughput benchmark for hwdecrypt.decrypt.
+# Run from anywhere after installing the module:
+#   python hwdecrypt_src/bench.py
+# Set HWDECRYPT_FORCE_SCALAR=1 to measure the byte-at-a-time kernel instead.
+import os
+import sys
+import time
+
+import hwdecrypt
+
+SIZES = [
+    ("4 KiB", 4 * 1024),
+    ("64 KiB", 64 * 1024),
+    ("64 MiB", 64 * 1024 * 1024),
+]
+# Each size is repeated until at least this many bytes have gone through decrypt.
+MIN_BYTES_PER_SIZE = 256 * 1024 * 1024
+MIN_ROUNDS = 3
+
+
+def bench_one(size: int) -> float:
+    buf = bytearray(os.urandom(size))
+    keyset = hwdecrypt.Keyset(0x12345678, 0x9ABCDEF0)
+    rounds = max(MIN_ROUNDS, MIN_BYTES_PER_SIZE // size)
+
+    t = time.perf_counter()
+    for _ in range(rounds):
+        hwdecrypt.decrypt(keyset, buf)
+    elapsed = time.perf_counter() - t
+
+    return (size * rounds) / elapsed / (1024 * 1024)
+
+
+def main():
+    print(f"hwdecrypt kernel: {getattr(hwdecrypt, 'KERNEL', 'scalar')}")
+    for label, size in SIZES:
+        print(f"{label:>8}: {bench_one(size):10.1f} MB/s")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
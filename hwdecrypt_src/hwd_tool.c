@@ -1,4 +1,5 @@
 #include <stdint.h>
+#include <string.h>
 
 struct hwd_keyset {
     uint32_t k1;
@@ -6,8 +7,40 @@ struct hwd_keyset {
     uint32_t k3;
 };
 
+#define hwd_LCG_MUL 0x343FD
+#define hwd_LCG_INC 0x269EC3
+
+// Buffers shorter than this go straight to the scalar loop, setting up the
+// lanes costs more than it saves.
+#define hwd_LANES_MIN_SIZE 64
+
+extern const char *hwd_select_kernel(int allow_lanes);
 extern void hwd_decrypt_buf(struct hwd_keyset *initp, uint8_t *buf, int size);
-void hwd_decrypt_buf(struct hwd_keyset *initp, uint8_t *buf, int size) {
+extern void hwd_keyset_advance(struct hwd_keyset *initp, uint64_t n);
+
+// Computes the affine map (x -> *mul_out * x + *inc_out) equal to n LCG steps.
+// One step is x -> a*x + c (mod 2^32); n steps are found by repeatedly
+// squaring the map and composing the powers selected by the bits of n.
+static void hwd_lcg_jump(uint64_t n, uint32_t *mul_out, uint32_t *inc_out) {
+    uint32_t acc_mul = 1, acc_inc = 0;
+    uint32_t cur_mul = hwd_LCG_MUL, cur_inc = hwd_LCG_INC;
+
+    while (n) {
+        if (n & 1) {
+            acc_mul *= cur_mul;
+            acc_inc = acc_inc * cur_mul + cur_inc;
+        }
+
+        cur_inc = cur_inc * cur_mul + cur_inc;
+        cur_mul *= cur_mul;
+        n >>= 1;
+    }
+
+    *mul_out = acc_mul;
+    *inc_out = acc_inc;
+}
+
+static void hwd_decrypt_buf_scalar(struct hwd_keyset *initp, uint8_t *buf, int size) {
     uint32_t mul1 = initp->k1;       // esi
     uint32_t mul2 = initp->k2;       // edi
     uint32_t mul_static = initp->k3; // ecx
@@ -24,14 +57,14 @@ void hwd_decrypt_buf(struct hwd_keyset *initp, uint8_t *buf, int size) {
         op ^= k2;
         op ^= k3;
 
-        mul1 *= 0x343FD;
-        mul1 += 0x269EC3;
+        mul1 *= hwd_LCG_MUL;
+        mul1 += hwd_LCG_INC;
 
-        mul2 *= 0x343FD;
-        mul2 += 0x269EC3;
+        mul2 *= hwd_LCG_MUL;
+        mul2 += hwd_LCG_INC;
 
-        mul_static *= 0x343FD;
-        mul_static += 0x269EC3;
+        mul_static *= hwd_LCG_MUL;
+        mul_static += hwd_LCG_INC;
         *buf++ = op;
     }
 
@@ -39,3 +72,100 @@ void hwd_decrypt_buf(struct hwd_keyset *initp, uint8_t *buf, int size) {
     initp->k2 = mul2;
     initp->k3 = mul_static;
 }
+
+// Multi-lane kernels. Lane i of each generator starts i steps ahead of the
+// keyset and is stepped LANES bytes at a time with the jump-ahead multiplier,
+// so the lanes don't depend on each other and the compiler can vectorize
+// across them. Each kernel returns the number of bytes processed, always a
+// multiple of LANES, and leaves the keyset at that position.
+#define hwd_DEFINE_LANE_KERNEL(NAME, LANES, ATTR)                                 \
+    ATTR static int NAME(struct hwd_keyset *initp, uint8_t *buf, int size) {      \
+        uint32_t s1[LANES], s2[LANES], s3[LANES];                                 \
+        uint32_t stride_mul, stride_inc;                                          \
+        int nblocks = size / LANES;                                               \
+        int i, j;                                                                 \
+                                                                                  \
+        s1[0] = initp->k1;                                                        \
+        s2[0] = initp->k2;                                                        \
+        s3[0] = initp->k3;                                                        \
+        for (i = 1; i < LANES; ++i) {                                             \
+            s1[i] = s1[i - 1] * hwd_LCG_MUL + hwd_LCG_INC;                        \
+            s2[i] = s2[i - 1] * hwd_LCG_MUL + hwd_LCG_INC;                        \
+            s3[i] = s3[i - 1] * hwd_LCG_MUL + hwd_LCG_INC;                        \
+        }                                                                         \
+        hwd_lcg_jump(LANES, &stride_mul, &stride_inc);                            \
+                                                                                  \
+        for (j = 0; j < nblocks; ++j) {                                           \
+            for (i = 0; i < LANES; ++i) {                                         \
+                buf[i] ^= (uint8_t)((s1[i] ^ s2[i] ^ s3[i]) >> 24);               \
+                s1[i] = s1[i] * stride_mul + stride_inc;                          \
+                s2[i] = s2[i] * stride_mul + stride_inc;                          \
+                s3[i] = s3[i] * stride_mul + stride_inc;                          \
+            }                                                                     \
+            buf += LANES;                                                         \
+        }                                                                         \
+                                                                                  \
+        initp->k1 = s1[0];                                                        \
+        initp->k2 = s2[0];                                                        \
+        initp->k3 = s3[0];                                                        \
+        return nblocks * LANES;                                                   \
+    }
+
+typedef int (*hwd_lane_kernel_t)(struct hwd_keyset *initp, uint8_t *buf, int size);
+
+// Portable version. Even without vector multiplies, 16 independent chains
+// hide the multiply latency that bounds the scalar loop.
+hwd_DEFINE_LANE_KERNEL(hwd_decrypt_buf_x16, 16, )
+
+#if (defined(__GNUC__) || defined(__clang__)) && (defined(__x86_64__) || defined(__i386__))
+#define hwd_HAVE_X86_DISPATCH
+// Baseline x86-64 has no packed 32-bit multiply, these need SSE4.1 (pmulld) or AVX2.
+hwd_DEFINE_LANE_KERNEL(hwd_decrypt_buf_x16_sse41, 16, __attribute__((target("sse4.1"))))
+hwd_DEFINE_LANE_KERNEL(hwd_decrypt_buf_x32_avx2, 32, __attribute__((target("avx2"))))
+#endif
+
+static hwd_lane_kernel_t hwd_lane_kernel = hwd_decrypt_buf_x16;
+
+// Picks the widest lane kernel the CPU supports. Called once when the module
+// is loaded; returns a short name for the selected kernel.
+const char *hwd_select_kernel(int allow_lanes) {
+    if (!allow_lanes) {
+        hwd_lane_kernel = NULL;
+        return "scalar";
+    }
+
+#ifdef hwd_HAVE_X86_DISPATCH
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("avx2")) {
+        hwd_lane_kernel = hwd_decrypt_buf_x32_avx2;
+        return "avx2";
+    }
+    if (__builtin_cpu_supports("sse4.1")) {
+        hwd_lane_kernel = hwd_decrypt_buf_x16_sse41;
+        return "sse4.1";
+    }
+#endif
+
+    hwd_lane_kernel = hwd_decrypt_buf_x16;
+    return "lanes";
+}
+
+void hwd_decrypt_buf(struct hwd_keyset *initp, uint8_t *buf, int size) {
+    int done = 0;
+
+    if (hwd_lane_kernel && size >= hwd_LANES_MIN_SIZE) {
+        done = hwd_lane_kernel(initp, buf, size);
+    }
+
+    hwd_decrypt_buf_scalar(initp, buf + done, size - done);
+}
+
+// Moves all three generators forward by n steps in O(log n).
+void hwd_keyset_advance(struct hwd_keyset *initp, uint64_t n) {
+    uint32_t jump_mul, jump_inc;
+
+    hwd_lcg_jump(n, &jump_mul, &jump_inc);
+    initp->k1 = initp->k1 * jump_mul + jump_inc;
+    initp->k2 = initp->k2 * jump_mul + jump_inc;
+    initp->k3 = initp->k3 * jump_mul + jump_inc;
+}
@@ -1,9 +1,17 @@
 #define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include <structmember.h>
+#include <pythread.h>
 
+#include <errno.h>
 #include <stdint.h>
 #include <stdlib.h>
+#include <string.h>
+#ifdef _WIN32
+#include <io.h>
+#else
+#include <unistd.h>
+#endif
 
 struct hwd_keyset {
     uint32_t k1;
@@ -16,9 +24,19 @@ typedef struct {
     struct hwd_keyset pk;
 } hwd_keyset_t;
 
+typedef struct {
+    PyObject_HEAD
+    struct hwd_keyset pk;
+    PyObject *decompressor;
+    PyObject *scratch;
+} hwd_master_stream_t;
+
 int hwdecrypt_exec_module(PyObject *module);
 static int keyset_init(hwd_keyset_t *self, PyObject *args, PyObject *kwds);
-static PyObject *decrypt_buffer(PyObject *self, PyObject *const *args, Py_ssize_t nargs);
+static PyObject *keyset_advance(hwd_keyset_t *self, PyObject *arg);
+static PyObject *decrypt_buffer(PyObject *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *decrypt_many(PyObject *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames);
+static PyObject *decrypt_file_range(PyObject *self, PyObject *const *args, Py_ssize_t nargs);
 
 static const PyMemberDef HWDKeysetTypeMembers[] = {
     {"key1", T_UINT, offsetof(hwd_keyset_t, pk.k1), 0, "key1"},
@@ -26,11 +44,16 @@ static const PyMemberDef HWDKeysetTypeMembers[] = {
     {"key3", T_UINT, offsetof(hwd_keyset_t, pk.k3), 0, "key3"},
     {NULL} /* Sentinel */
 };
+static const PyMethodDef HWDKeysetTypeMethods[] = {
+    {"advance", (PyCFunction)keyset_advance, METH_O, "Skip the RNG state forward by n bytes."},
+    {NULL, NULL, 0, NULL}
+};
 static const PyType_Slot HWDKeysetTypeSlots[] = {
     {Py_tp_doc, "Contains the RNG state for the stream cipher."},
     {Py_tp_new, PyType_GenericNew},
     {Py_tp_init, (initproc)keyset_init},
     {Py_tp_members, &HWDKeysetTypeMembers},
+    {Py_tp_methods, &HWDKeysetTypeMethods},
     {0, NULL}
 };
 static const PyType_Spec HWDKeysetType = {
@@ -41,8 +64,47 @@ static const PyType_Spec HWDKeysetType = {
     .slots = &HWDKeysetTypeSlots,
 };
 
+static int master_stream_init(hwd_master_stream_t *self, PyObject *args, PyObject *kwds);
+static void master_stream_dealloc(hwd_master_stream_t *self);
+static PyObject *master_stream_decompress(hwd_master_stream_t *self, PyObject *arg);
+static PyObject *master_stream_flush(hwd_master_stream_t *self, PyObject *unused);
+
+static const PyMethodDef HWDMasterStreamTypeMethods[] = {
+    {"decompress", (PyCFunction)master_stream_decompress, METH_O,
+        "Decrypt and inflate the next chunk of the stream, returning the output produced so far."},
+    {"flush", (PyCFunction)master_stream_flush, METH_NOARGS, "Return any remaining inflated output."},
+    {NULL, NULL, 0, NULL}
+};
+static const PyType_Slot HWDMasterStreamTypeSlots[] = {
+    {Py_tp_doc, "Decrypts and inflates an encrypted master database, one chunk at a time.\n\n"
+                "MasterStream(keyset) takes a copy of the keyset's state; the keyset itself is not modified."},
+    {Py_tp_new, PyType_GenericNew},
+    {Py_tp_init, (initproc)master_stream_init},
+    {Py_tp_dealloc, (destructor)master_stream_dealloc},
+    {Py_tp_methods, &HWDMasterStreamTypeMethods},
+    {0, NULL}
+};
+static const PyType_Spec HWDMasterStreamType = {
+    .name = "hwdecrypt.MasterStream",
+    .basicsize = sizeof(hwd_master_stream_t),
+    .itemsize = 0,
+    .flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HEAPTYPE,
+    .slots = &HWDMasterStreamTypeSlots,
+};
+
 static const PyMethodDef HWDTopLevel[] = {
-    {"decrypt", decrypt_buffer, METH_FASTCALL, "Decrypt the data within a buffer object."},
+    {"decrypt", (PyCFunction)decrypt_buffer, METH_FASTCALL | METH_KEYWORDS,
+        "Decrypt the data within a buffer object.\n\n"
+        "If offset is given, the keyset is first advanced by that many bytes."},
+    {"decrypt_many", (PyCFunction)decrypt_many, METH_FASTCALL | METH_KEYWORDS,
+        "Decrypt a sequence of (Keyset, buffer) pairs in one call, without holding the GIL.\n\n"
+        "threads (default 1) spreads large batches over that many threads. When using more\n"
+        "than one, a Keyset must not appear in more than one pair."},
+    {"decrypt_file_range", (PyCFunction)decrypt_file_range, METH_FASTCALL,
+        "decrypt_file_range(keyset, src_fd, offset, size, dst_fd)\n\n"
+        "Decrypt size bytes of src_fd starting at offset and write them to dst_fd at its current\n"
+        "position, through a fixed-size internal buffer. Returns the number of bytes written, which\n"
+        "is less than size if src_fd ends early."},
     {NULL, NULL, 0, NULL}
 };
 
@@ -65,7 +127,14 @@ static PyModuleDef modinfo = {
 };
 
 #define hwd_K3_DEFAULT 0x3039
+// Buffers at least this big are decrypted with the GIL released.
+#define hwd_GIL_RELEASE_THRESHOLD (16 * 1024)
+#define hwd_BATCH_MAX_THREADS 16
+#define hwd_BATCH_MIN_BYTES_PER_THREAD (1024 * 1024)
+#define hwd_FILE_RANGE_BUFFER_SIZE (1024 * 1024)
 void hwd_decrypt_buf(struct hwd_keyset *initp, uint8_t *buf, int size);
+void hwd_keyset_advance(struct hwd_keyset *initp, uint64_t n);
+const char *hwd_select_kernel(int allow_lanes);
 
 ////////////////////////////////////////////////////////
 
@@ -83,12 +152,329 @@ static int keyset_init(hwd_keyset_t *self, PyObject *args, PyObject *kwds) {
     return 0;
 }
 
-static PyObject *decrypt_buffer(PyObject *self, PyObject *const *args, Py_ssize_t nargs) {
+static int parse_offset(PyObject *arg, unsigned long long *out) {
+    unsigned long long val = PyLong_AsUnsignedLongLong(arg);
+    if (val == (unsigned long long)-1 && PyErr_Occurred()) {
+        return -1;
+    }
+
+    *out = val;
+    return 0;
+}
+
+static PyObject *keyset_advance(hwd_keyset_t *self, PyObject *arg) {
+    unsigned long long n;
+
+    if (parse_offset(arg, &n) != 0) {
+        return NULL;
+    }
+
+    hwd_keyset_advance(&self->pk, n);
+    Py_RETURN_NONE;
+}
+
+// Argument parsing for the FASTCALL functions below: npos required positional
+// arguments, followed by one optional argument that may also be passed by name.
+static int parse_args_with_optional(PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames,
+                                    Py_ssize_t npos, const char *kwname, PyObject **optional) {
+    Py_ssize_t nkw = kwnames ? PyTuple_GET_SIZE(kwnames) : 0;
+
+    *optional = NULL;
+    if (nkw == 1 && nargs == npos) {
+        if (!PyUnicode_Check(PyTuple_GET_ITEM(kwnames, 0))
+            || PyUnicode_CompareWithASCIIString(PyTuple_GET_ITEM(kwnames, 0), kwname) != 0) {
+            PyErr_Format(PyExc_TypeError, "The only keyword argument accepted is '%s'.", kwname);
+            return -1;
+        }
+        *optional = args[npos];
+    } else if (nkw == 0 && nargs == npos + 1) {
+        *optional = args[npos];
+    } else if (nkw != 0 || nargs != npos) {
+        PyErr_SetString(PyExc_TypeError, "Wrong number of arguments.");
+        return -1;
+    }
+
+    return 0;
+}
+
+static int get_decrypt_target(hwd_module_private_t *private, PyObject *keyset, PyObject *buffer, Py_buffer *edata) {
+    if (Py_TYPE(keyset) != private->keyset_type) {
+        PyErr_SetString(PyExc_TypeError, "The first argument must be a Keyset.");
+        return -1;
+    }
+
+    if (PyObject_GetBuffer(buffer, edata, PyBUF_WRITABLE | PyBUF_SIMPLE) != 0) {
+        return -1;
+    }
+
+    if (edata->len > INT_MAX || edata->len < 0) {
+        PyErr_SetString(PyExc_ValueError, "invalid size");
+        PyBuffer_Release(edata);
+        return -1;
+    }
+
+    return 0;
+}
+
+static PyObject *decrypt_buffer(PyObject *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames) {
     hwd_module_private_t *private = PyModule_GetState(self);
     hwd_keyset_t *keyset;
     Py_buffer edata;
+    PyObject *offset_arg;
+    unsigned long long offset = 0;
+
+    if (parse_args_with_optional(args, nargs, kwnames, 2, "offset", &offset_arg) != 0) {
+        return NULL;
+    }
+
+    if (offset_arg && parse_offset(offset_arg, &offset) != 0) {
+        return NULL;
+    }
+
+    if (get_decrypt_target(private, args[0], args[1], &edata) != 0) {
+        return NULL;
+    }
+    keyset = (hwd_keyset_t *)args[0];
+
+    if (offset) {
+        hwd_keyset_advance(&keyset->pk, offset);
+    }
+
+    if (edata.len >= hwd_GIL_RELEASE_THRESHOLD) {
+        Py_BEGIN_ALLOW_THREADS
+        hwd_decrypt_buf(&keyset->pk, edata.buf, edata.len);
+        Py_END_ALLOW_THREADS
+    } else {
+        hwd_decrypt_buf(&keyset->pk, edata.buf, edata.len);
+    }
+    PyBuffer_Release(&edata);
+
+    Py_RETURN_NONE;
+}
+
+////////////////////////////////////////////////////////
+
+typedef struct {
+    struct hwd_keyset *keys;
+    Py_buffer edata;
+} hwd_batch_job_t;
+
+typedef struct {
+    hwd_batch_job_t *jobs;
+    Py_ssize_t start;
+    Py_ssize_t end;
+    PyThread_type_lock done;
+} hwd_batch_range_t;
+
+static void decrypt_batch_range(hwd_batch_range_t *range) {
+    for (Py_ssize_t i = range->start; i < range->end; ++i) {
+        hwd_decrypt_buf(range->jobs[i].keys, range->jobs[i].edata.buf, (int)range->jobs[i].edata.len);
+    }
+}
+
+static void decrypt_batch_worker(void *arg) {
+    hwd_batch_range_t *range = arg;
+    decrypt_batch_range(range);
+    PyThread_release_lock(range->done);
+}
+
+// Splits the jobs into at most nthreads contiguous ranges of roughly equal byte counts.
+// Returns the number of ranges actually used.
+static int partition_batch(hwd_batch_job_t *jobs, Py_ssize_t njobs, Py_ssize_t total,
+                           hwd_batch_range_t *ranges, int nthreads) {
+    Py_ssize_t acc = 0, start = 0;
+    int nranges = 0;
+
+    for (Py_ssize_t i = 0; i < njobs && nranges < nthreads - 1; ++i) {
+        acc += jobs[i].edata.len;
+        if (acc >= (total / nthreads) * (nranges + 1)) {
+            ranges[nranges].jobs = jobs;
+            ranges[nranges].start = start;
+            ranges[nranges].end = i + 1;
+            ranges[nranges].done = NULL;
+            nranges++;
+            start = i + 1;
+        }
+    }
+
+    ranges[nranges].jobs = jobs;
+    ranges[nranges].start = start;
+    ranges[nranges].end = njobs;
+    ranges[nranges].done = NULL;
+    return nranges + 1;
+}
+
+static void run_batch(hwd_batch_job_t *jobs, Py_ssize_t njobs, Py_ssize_t total, int nthreads) {
+    hwd_batch_range_t ranges[hwd_BATCH_MAX_THREADS];
+    int nranges;
+
+    // Don't bother starting threads that would only get a sliver of work each.
+    if (nthreads > total / hwd_BATCH_MIN_BYTES_PER_THREAD) {
+        nthreads = (int)(total / hwd_BATCH_MIN_BYTES_PER_THREAD);
+    }
+    if (nthreads < 1) {
+        nthreads = 1;
+    }
+
+    nranges = partition_batch(jobs, njobs, total, ranges, nthreads);
+
+    // ranges[0] is done on the calling thread. If a lock or thread can't be
+    // created, that range is also done here instead.
+    for (int i = 1; i < nranges; ++i) {
+        ranges[i].done = PyThread_allocate_lock();
+        if (ranges[i].done == NULL) {
+            continue;
+        }
+
+        PyThread_acquire_lock(ranges[i].done, WAIT_LOCK);
+        if (PyThread_start_new_thread(decrypt_batch_worker, &ranges[i]) == PYTHREAD_INVALID_THREAD_ID) {
+            PyThread_release_lock(ranges[i].done);
+            PyThread_free_lock(ranges[i].done);
+            ranges[i].done = NULL;
+        }
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    decrypt_batch_range(&ranges[0]);
+    for (int i = 1; i < nranges; ++i) {
+        if (ranges[i].done) {
+            PyThread_acquire_lock(ranges[i].done, WAIT_LOCK);
+        } else {
+            decrypt_batch_range(&ranges[i]);
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    for (int i = 1; i < nranges; ++i) {
+        if (ranges[i].done) {
+            PyThread_release_lock(ranges[i].done);
+            PyThread_free_lock(ranges[i].done);
+        }
+    }
+}
+
+static PyObject *decrypt_many(PyObject *self, PyObject *const *args, Py_ssize_t nargs, PyObject *kwnames) {
+    hwd_module_private_t *private = PyModule_GetState(self);
+    PyObject *threads_arg, *seq, *item;
+    hwd_batch_job_t *jobs;
+    PyObject **keysets;
+    Py_ssize_t njobs, nready = 0, total = 0;
+    long nthreads = 1;
+
+    if (parse_args_with_optional(args, nargs, kwnames, 1, "threads", &threads_arg) != 0) {
+        return NULL;
+    }
+
+    if (threads_arg) {
+        nthreads = PyLong_AsLong(threads_arg);
+        if (nthreads == -1 && PyErr_Occurred()) {
+            return NULL;
+        }
+        if (nthreads < 1 || nthreads > hwd_BATCH_MAX_THREADS) {
+            PyErr_Format(PyExc_ValueError, "threads must be between 1 and %d.", hwd_BATCH_MAX_THREADS);
+            return NULL;
+        }
+    }
 
-    if (nargs != 2) {
+    seq = PySequence_Fast(args[0], "The argument must be a sequence of (Keyset, buffer) pairs.");
+    if (seq == NULL) {
+        return NULL;
+    }
+
+    njobs = PySequence_Fast_GET_SIZE(seq);
+    jobs = PyMem_Calloc(njobs ? njobs : 1, sizeof(hwd_batch_job_t));
+    keysets = PyMem_Calloc(njobs ? njobs : 1, sizeof(PyObject *));
+    if (jobs == NULL || keysets == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    // Collect everything up front, holding our own references to the keysets
+    // and buffers, since the GIL is released while they're in use.
+    for (; nready < njobs; ++nready) {
+        item = PySequence_Fast_GET_ITEM(seq, nready);
+        if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != 2) {
+            PyErr_SetString(PyExc_TypeError, "Each job must be a (Keyset, buffer) tuple.");
+            goto done;
+        }
+
+        if (get_decrypt_target(private, PyTuple_GET_ITEM(item, 0), PyTuple_GET_ITEM(item, 1), &jobs[nready].edata) != 0) {
+            goto done;
+        }
+
+        keysets[nready] = PyTuple_GET_ITEM(item, 0);
+        Py_INCREF(keysets[nready]);
+        jobs[nready].keys = &((hwd_keyset_t *)keysets[nready])->pk;
+        total += jobs[nready].edata.len;
+    }
+
+    run_batch(jobs, njobs, total, (int)nthreads);
+
+done:
+    for (Py_ssize_t i = 0; i < nready; ++i) {
+        PyBuffer_Release(&jobs[i].edata);
+        Py_DECREF(keysets[i]);
+    }
+    PyMem_Free(jobs);
+    PyMem_Free(keysets);
+    Py_DECREF(seq);
+
+    if (PyErr_Occurred()) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+////////////////////////////////////////////////////////
+
+// Positioned read/sequential write helpers for decrypt_file_range. Both return
+// the byte count, or -1 with errno set. Called without the GIL.
+static Py_ssize_t hwd_pread(int fd, uint8_t *buf, Py_ssize_t len, long long offset) {
+#ifdef _WIN32
+    if (_lseeki64(fd, offset, SEEK_SET) < 0) {
+        return -1;
+    }
+    return _read(fd, buf, (unsigned int)len);
+#else
+    Py_ssize_t ret;
+    do {
+        ret = pread(fd, buf, len, (off_t)offset);
+    } while (ret < 0 && errno == EINTR);
+    return ret;
+#endif
+}
+
+static Py_ssize_t hwd_write_all(int fd, const uint8_t *buf, Py_ssize_t len) {
+    Py_ssize_t done = 0, ret;
+
+    while (done < len) {
+#ifdef _WIN32
+        ret = _write(fd, buf + done, (unsigned int)(len - done));
+#else
+        ret = write(fd, buf + done, len - done);
+        if (ret < 0 && errno == EINTR) {
+            continue;
+        }
+#endif
+        if (ret < 0) {
+            return -1;
+        }
+        done += ret;
+    }
+
+    return done;
+}
+
+static PyObject *decrypt_file_range(PyObject *self, PyObject *const *args, Py_ssize_t nargs) {
+    hwd_module_private_t *private = PyModule_GetState(self);
+    hwd_keyset_t *keyset;
+    int src_fd, dst_fd;
+    long long offset, size;
+    Py_ssize_t want, got = 0, done = 0;
+    uint8_t *work;
+    int saved_errno = 0;
+
+    if (nargs != 5) {
         PyErr_SetString(PyExc_TypeError, "Wrong number of arguments.");
         return NULL;
     }
@@ -99,23 +485,175 @@ static PyObject *decrypt_buffer(PyObject *self, PyObject *const *args, Py_ssize_
     }
     keyset = (hwd_keyset_t *)args[0];
 
-    if (PyObject_GetBuffer(args[1], &edata, PyBUF_WRITABLE | PyBUF_SIMPLE) != 0) {
+    if ((src_fd = PyObject_AsFileDescriptor(args[1])) < 0 || (dst_fd = PyObject_AsFileDescriptor(args[4])) < 0) {
+        return NULL;
+    }
+
+    offset = PyLong_AsLongLong(args[2]);
+    if (offset == -1 && PyErr_Occurred()) {
         return NULL;
     }
+    size = PyLong_AsLongLong(args[3]);
+    if (size == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+    if (offset < 0 || size < 0) {
+        PyErr_SetString(PyExc_ValueError, "offset and size must not be negative");
+        return NULL;
+    }
+
+    work = PyMem_Malloc(hwd_FILE_RANGE_BUFFER_SIZE);
+    if (work == NULL) {
+        return PyErr_NoMemory();
+    }
 
-    if (edata.len > INT_MAX || edata.len < 0) {
+    Py_BEGIN_ALLOW_THREADS
+    while (done < size) {
+        want = size - done < hwd_FILE_RANGE_BUFFER_SIZE ? (Py_ssize_t)(size - done) : hwd_FILE_RANGE_BUFFER_SIZE;
+        got = hwd_pread(src_fd, work, want, offset + done);
+        if (got <= 0) {
+            break;
+        }
+
+        hwd_decrypt_buf(&keyset->pk, work, (int)got);
+        if (hwd_write_all(dst_fd, work, got) < 0) {
+            got = -1;
+            break;
+        }
+        done += got;
+    }
+    saved_errno = errno;
+    Py_END_ALLOW_THREADS
+
+    PyMem_Free(work);
+
+    if (got < 0) {
+        errno = saved_errno;
+        return PyErr_SetFromErrno(PyExc_OSError);
+    }
+
+    return PyLong_FromSsize_t(done);
+}
+
+static int read_key_attr(PyObject *keyset, const char *name, uint32_t *out) {
+    PyObject *val = PyObject_GetAttrString(keyset, name);
+    unsigned long lval;
+
+    if (val == NULL) {
+        return -1;
+    }
+
+    lval = PyLong_AsUnsignedLong(val);
+    Py_DECREF(val);
+    if (lval == (unsigned long)-1 && PyErr_Occurred()) {
+        return -1;
+    }
+
+    *out = (uint32_t)lval;
+    return 0;
+}
+
+static int master_stream_init(hwd_master_stream_t *self, PyObject *args, PyObject *kwds) {
+    PyObject *keyset, *zlib;
+
+    if (!PyArg_ParseTuple(args, "O", &keyset)) {
+        return -1;
+    }
+
+    if (read_key_attr(keyset, "key1", &self->pk.k1) != 0
+        || read_key_attr(keyset, "key2", &self->pk.k2) != 0
+        || read_key_attr(keyset, "key3", &self->pk.k3) != 0) {
+        return -1;
+    }
+
+    // Masters are raw deflate streams. Inflation is delegated to the zlib
+    // module so the extension doesn't need to link against zlib itself.
+    zlib = PyImport_ImportModule("zlib");
+    if (zlib == NULL) {
+        return -1;
+    }
+
+    Py_CLEAR(self->decompressor);
+    self->decompressor = PyObject_CallMethod(zlib, "decompressobj", "i", -15);
+    Py_DECREF(zlib);
+    if (self->decompressor == NULL) {
+        return -1;
+    }
+
+    Py_CLEAR(self->scratch);
+    self->scratch = PyByteArray_FromStringAndSize(NULL, 0);
+    if (self->scratch == NULL) {
+        return -1;
+    }
+
+    return 0;
+}
+
+static void master_stream_dealloc(hwd_master_stream_t *self) {
+    PyTypeObject *tp = Py_TYPE(self);
+
+    Py_XDECREF(self->decompressor);
+    Py_XDECREF(self->scratch);
+    tp->tp_free((PyObject *)self);
+#if PY_VERSION_HEX >= 0x03080000
+    Py_DECREF(tp);
+#endif
+}
+
+static PyObject *master_stream_decompress(hwd_master_stream_t *self, PyObject *arg) {
+    Py_buffer edata;
+    uint8_t *work;
+
+    if (self->decompressor == NULL) {
+        PyErr_SetString(PyExc_ValueError, "MasterStream was not initialized.");
+        return NULL;
+    }
+
+    if (PyObject_GetBuffer(arg, &edata, PyBUF_SIMPLE) != 0) {
+        return NULL;
+    }
+
+    if (edata.len > INT_MAX) {
         PyErr_SetString(PyExc_ValueError, "invalid size");
         PyBuffer_Release(&edata);
         return NULL;
     }
 
-    hwd_decrypt_buf(&keyset->pk, edata.buf, edata.len);
+    // The scratch bytearray is reused for every chunk. zlib copies anything it
+    // needs to keep, and the resize fails loudly if someone still holds a view.
+    if (PyByteArray_GET_SIZE(self->scratch) != edata.len
+        && PyByteArray_Resize(self->scratch, edata.len) != 0) {
+        PyBuffer_Release(&edata);
+        return NULL;
+    }
+
+    work = (uint8_t *)PyByteArray_AS_STRING(self->scratch);
+    memcpy(work, edata.buf, edata.len);
     PyBuffer_Release(&edata);
 
-    Py_RETURN_NONE;
+    hwd_decrypt_buf(&self->pk, work, (int)PyByteArray_GET_SIZE(self->scratch));
+    return PyObject_CallMethod(self->decompressor, "decompress", "O", self->scratch);
+}
+
+static PyObject *master_stream_flush(hwd_master_stream_t *self, PyObject *unused) {
+    if (self->decompressor == NULL) {
+        PyErr_SetString(PyExc_ValueError, "MasterStream was not initialized.");
+        return NULL;
+    }
+
+    return PyObject_CallMethod(self->decompressor, "flush", NULL);
 }
 
 int hwdecrypt_exec_module(PyObject *module) {
+    // The multi-lane kernel is used whenever it's worthwhile. Setting this
+    // variable pins everything to the byte-at-a-time loop (for benchmarking).
+    const char *force_scalar = getenv("HWDECRYPT_FORCE_SCALAR");
+    int allow_lanes = !(force_scalar && force_scalar[0] && strcmp(force_scalar, "0") != 0);
+
+    if (PyModule_AddStringConstant(module, "KERNEL", hwd_select_kernel(allow_lanes)) < 0) {
+        return -1;
+    }
+
     PyObject *kstype_real = PyType_FromSpec(&HWDKeysetType);
     if (PyModule_AddObject(module, "Keyset", (PyObject *)kstype_real) < 0) {
         Py_DECREF(kstype_real);
@@ -124,6 +662,12 @@ int hwdecrypt_exec_module(PyObject *module) {
 
     hwd_module_private_t *private = PyModule_GetState(module);
     private->keyset_type = kstype_real;
+
+    PyObject *mstype_real = PyType_FromSpec(&HWDMasterStreamType);
+    if (PyModule_AddObject(module, "MasterStream", mstype_real) < 0) {
+        Py_XDECREF(mstype_real);
+        return -1;
+    }
     return 0;
 }
 